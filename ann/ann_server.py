@@ -0,0 +1,305 @@
+# ann_server.py
+#
+# Warm annotation server
+#
+# Starting run.py for every job costs an interpreter start, the imports of
+# boto3, NumPy and AnnTools, and loading the reference data before any
+# record is annotated. The server pays that once: it imports run.py and
+# loads the configured annotation engine, then listens on a Unix socket.
+# For each job it forks a child that runs run.run_job on the input file,
+# so jobs start in milliseconds, share the loaded pages with the server
+# and stay isolated from each other (a crashed or killed job takes nothing
+# else down).
+#
+# Protocol, one JSON object per line: the client sends {"input_path": ...};
+# the server answers {"pid": ...} once the job started and
+# {"exit_code": ...} when it ended (negative for a signal, as in Popen).
+# Meanwhile the client may send {"kill": true}; a client that disconnects
+# has its job killed, since nobody is left to report it. submit() wraps
+# this in a RemoteJob with the wait() and kill() calls of a Popen object,
+# which annotator.py uses in place of spawning run.py.
+#
+# The server is a single thread: one selector loop accepts clients, reads
+# their messages and, woken by SIGCHLD, reaps finished jobs. Only job
+# processes are forked from it, so no other thread can hold a lock (e.g.
+# that of stdout) across a fork, and the pid of a job is only signalled
+# by the process that reaps it.
+#
+# Usage: python ann_server.py (from this directory, like annotator.py);
+# run_ann.sh starts it next to the annotator and restarts it if it exits
+##
+import os
+import sys
+import json
+import signal
+import socket
+import selectors
+import traceback
+from configparser import ConfigParser
+
+
+"""Handle to a job running in the annotation server
+"""
+class RemoteJob(object):
+    def __init__(self, sock, pid):
+        self.sock = sock
+        self.file = sock.makefile("r")
+        self.pid = pid
+        self.returncode = None
+
+    def wait(self):
+        """
+        Wait for the job to end and return its exit code; a lost server
+        connection counts as a failure
+        """
+        if self.returncode is None:
+            try:
+                line = self.file.readline()
+                self.returncode = json.loads(line)["exit_code"] if line else 1
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Lost annotation server connection: {e}")
+                self.returncode = 1
+            self.file.close()
+            self.sock.close()
+        return self.returncode
+
+    def kill(self):
+        """
+        Ask the server to kill the job; the server, which reaps the job,
+        is the only process that can tell whether its pid is still the job's
+        """
+        if self.returncode is None:
+            try:
+                self.sock.sendall((json.dumps({"kill": True}) + "\n").encode())
+            except OSError:
+                pass
+
+
+def submit(socket_path, input_path):
+    """
+    Start a job in the annotation server; None if the server is not
+    reachable or refused the job
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps({"input_path": input_path}) + "\n").encode())
+        job = RemoteJob(sock, None)
+        reply = json.loads(job.file.readline())
+        job.pid = reply["pid"]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Annotation server at {socket_path} is unavailable: {e}")
+        sock.close()
+        return None
+    return job
+
+def run_child(run, input_path):
+    """
+    Body of a forked job process; never returns
+    """
+    code = 0
+    try:
+        run.run_job(input_path)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+"""Accepts job requests and runs each in a forked process
+"""
+class AnnServer(object):
+    def __init__(self, socket_path, run):
+        self.socket_path = socket_path
+        self.run = run
+        # pid -> client connection of each running job
+        self.jobs = {}
+        # client connection -> pid of its job, once started
+        self.pids = {}
+        # client connection -> bytes received but not yet handled
+        self.buffers = {}
+
+        self.selector = selectors.DefaultSelector()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the service user may connect (and so have jobs run on any
+        # path); the socket is created without group or other access
+        umask = os.umask(0o177)
+        try:
+            self.listener.bind(socket_path)
+        finally:
+            os.umask(umask)
+        self.listener.listen()
+        self.selector.register(self.listener, selectors.EVENT_READ, self.accept)
+
+        # SIGCHLD wakes the selector through a pipe
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        signal.set_wakeup_fd(self.wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ, self.reap)
+
+    def serve_forever(self):
+        print(f"Annotation server listening on {self.socket_path}")
+        while True:
+            for key, _ in self.selector.select():
+                key.data(key.fileobj)
+
+    def accept(self, listener):
+        conn, _ = listener.accept()
+        self.buffers[conn] = b""
+        self.selector.register(conn, selectors.EVENT_READ, self.receive)
+
+    def close(self, conn):
+        try:
+            self.selector.unregister(conn)
+        except KeyError:
+            pass
+        self.buffers.pop(conn, None)
+        self.pids.pop(conn, None)
+        conn.close()
+
+    def receive(self, conn):
+        try:
+            data = conn.recv(4096)
+        except OSError:
+            data = b""
+        if not data:
+            pid = self.pids.get(conn)
+            if pid is None:
+                self.close(conn)
+                return
+            # The client is gone, so nobody waits for the job; the
+            # connection is closed once the job is reaped
+            print(f"Client of job process {pid} disconnected, killing it")
+            self.selector.unregister(conn)
+            os.kill(pid, signal.SIGKILL)
+            return
+
+        self.buffers[conn] += data
+        while conn in self.buffers and b"\n" in self.buffers[conn]:
+            line, self.buffers[conn] = self.buffers[conn].split(b"\n", 1)
+            self.handle_message(conn, line)
+
+    def handle_message(self, conn, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            print(f"Invalid message from annotation client: {line[:200]}")
+            self.close(conn)
+            return
+
+        pid = self.pids.get(conn)
+        if pid is not None:
+            # Not reaped yet, so the pid is still the job's
+            if message.get("kill"):
+                print(f"Killing job process {pid}")
+                os.kill(pid, signal.SIGKILL)
+            return
+
+        input_path = message.get("input_path")
+        if not isinstance(input_path, str):
+            print(f"Invalid job request: {message}")
+            self.close(conn)
+            return
+        self.start_job(conn, input_path)
+
+    def start_job(self, conn, input_path):
+        # Output buffered so far would otherwise be written again by the child
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.close_in_child()
+            run_child(self.run, input_path)
+
+        print(f"Started job process {pid} on {input_path}")
+        self.jobs[pid] = conn
+        self.pids[conn] = pid
+        try:
+            conn.sendall((json.dumps({"pid": pid}) + "\n").encode())
+        except OSError:
+            # The client is gone, so nobody waits for the job
+            self.selector.unregister(conn)
+            os.kill(pid, signal.SIGKILL)
+
+    def close_in_child(self):
+        """
+        Drop the server's sockets and signal handling in a job process
+        """
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        self.selector.close()
+        self.listener.close()
+        for conn in self.buffers:
+            conn.close()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+    def reap(self, wakeup_read):
+        """
+        Collect finished jobs and send their exit codes to their clients
+        """
+        try:
+            while os.read(wakeup_read, 512):
+                pass
+        except BlockingIOError:
+            pass
+        while self.jobs:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            conn = self.jobs.pop(pid, None)
+            if conn is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            print(f"Job process {pid} finished with exit code {code}")
+            try:
+                conn.sendall((json.dumps({"exit_code": code}) + "\n").encode())
+            except OSError:
+                pass
+            self.close(conn)
+
+    def shutdown(self):
+        self.selector.close()
+        self.listener.close()
+        os.remove(self.socket_path)
+
+def serve(socket_path):
+    """
+    Load the annotation code and reference data, then run jobs for clients
+    of socket_path until interrupted
+    """
+    # Imported here so that clients of submit() stay light
+    sys.path.append("anntools")
+    import driver
+    import run
+
+    config = ConfigParser(os.environ)
+    config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
+    run.annotation_engine(config)
+
+    server = AnnServer(socket_path, run)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+if __name__ == '__main__':
+    config = ConfigParser(os.environ)
+    config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
+    serve(config["ann"]["AnnServerSocket"])
+
+### EOF
@@ -1,8 +1,14 @@
 import subprocess
-import boto3
-import json
 from botocore.exceptions import ClientError
 import os
+import sys
+import threading
+
+import s3_stream
+import ann_server
+sys.path.append("../util")
+import aws_clients
+import sqs_consumer
 
 # Get util configuration
 from configparser import ConfigParser
@@ -13,66 +19,69 @@ region_name = config["ann"]['AwsRegionName']
 queue_name = config["ann"]['AwsQueueName']
 WaitTimeBetweenMessage = int(config["ann"]["WaitTimeBetweenMessage"])
 dynamo_table_name = config["ann"]["AWS_DYNAMODB_ANNOTATIONS_TABLE"]
-
-sqs_client = boto3.client("sqs", region_name = region_name)
-
-
-def receive_message(url):
-    try:
-        response = sqs_client.receive_message(
-            QueueUrl=url,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=WaitTimeBetweenMessage,
-        )
-    except ClientError as e:
-        print(e)
-        return None
-    messages = response.get("Messages", [])
-    print(f"Number of messages received: {len(messages)}")
-    if len(messages) > 0:
-        return messages[0]
-    return None
-
-def parse_response(response):
+annotation_folder = config["ann"]["AnnotationFolder"]
+
+# Worker pool settings: number of run.py jobs allowed to run at once, and the
+# maximum number of messages to take per receive (SQS caps this at 10)
+worker_slots = int(config["ann"]["WorkerSlots"])
+max_messages = int(config["ann"]["MaxMessagesPerReceive"])
+
+# Visibility heartbeat settings: while a job runs, its message is hidden for
+# another VisibilityTimeout seconds every HeartbeatInterval seconds
+visibility_timeout = int(config["ann"]["VisibilityTimeout"])
+heartbeat_interval = int(config["ann"]["HeartbeatInterval"])
+
+# Streaming input settings: when enabled, input files are not downloaded but
+# streamed from S3 into a named pipe in ranges of StreamChunkSize bytes, with
+# up to StreamReadAhead ranges requested ahead of the annotator
+stream_input = config["ann"].getboolean("StreamInput")
+stream_chunk_size = int(config["ann"]["StreamChunkSize"])
+stream_read_ahead = int(config["ann"]["StreamReadAhead"])
+
+# Warm annotation server: jobs run in processes forked by ann_server.py when
+# its socket exists, and in a new run.py process otherwise
+ann_server_socket = config["ann"]["AnnServerSocket"]
+
+
+def wait_for_job(job_id, process, input_path, feeder):
+    """
+    Wait for a run.py process and, for streamed inputs, its feeder thread.
+    The job's message may only be deleted once run.py exits cleanly, i.e.
+    after the job reached COMPLETED; failed jobs are redelivered once the
+    visibility timeout lapses
+    """
+    return_code = process.wait()
+    if feeder is not None and feeder.is_alive():
+        s3_stream.release_fifo(input_path)
+        feeder.join()
+    print(f"Job {job_id} finished with exit code {return_code}")
+    if return_code != 0:
+        print(f"Job {job_id} will be retried after redelivery")
+    return return_code == 0
+
+def start_job(input_path):
+    """
+    Run a job on a downloaded or streamed input file, in the annotation
+    server if it is up, else by spawning run.py
+    """
+    if ann_server_socket and os.path.exists(ann_server_socket):
+        process = ann_server.submit(ann_server_socket, input_path)
+        if process is not None:
+            print(f"Job process {process.pid} was started by the annotation server")
+            return process
     try:
-        json_response = json.loads(response)
-        json_body = json.loads(json_response["Message"])
-        return json_body
-    except Exception as e:
+        process = subprocess.Popen([sys.executable, "run.py", input_path])
+        print("A new process was spawned to run the annotation file")
+    except (OSError, subprocess.SubprocessError) as e:
         print(e)
         return None
+    return process
 
-def delete_msg(url, handle):
-    try:
-        response = sqs_client.delete_message(
-            QueueUrl=url,
-            ReceiptHandle=handle,
-        )
-        messageID = response["ResponseMetadata"]["RequestId"]
-        print("message deleted")
-    except ClientError as e:
-        print(e)
-
-try:
-    queue_url = sqs_client.get_queue_url(QueueName=queue_name)["QueueUrl"]
-except ClientError as e:
-    print(e)
-
-while True:
-    # Long poll for message on provided SQS queue, if no response, continue
-    response = receive_message(queue_url)
-    if response == None:
-        continue
-    
-
-    message_handle = response["ReceiptHandle"]
-    message_body = response["Body"]
-
-    # If json_data is not successfully parsed, continue
-    json_data = parse_response(message_body)
-    if json_data == None:
-        continue
-
+def process_message(json_data):
+    """
+    Run one annotation job in a worker slot, until it completes. Returns
+    True when the job's message can be deleted
+    """
     job_id = json_data["job_id"]
     user_id = json_data["user_id"]
     input_file_name = json_data["input_file_name"]
@@ -81,8 +90,42 @@ while True:
     submit_time = json_data["submit_time"]
     json_data["job_status"] = "RUNNING"
 
+    # Update dynamoDB to show process as running. A redelivered message may
+    # find the job already RUNNING; a COMPLETED job needs no further work
+    try:
+        table = aws_clients.get_table(dynamo_table_name, region_name)
+        response = table.update_item(
+            Key = {"job_id": job_id}, 
+            UpdateExpression="set job_status = :j",
+            ConditionExpression = "job_status IN (:p, :j)",
+            ExpressionAttributeValues={":j": "RUNNING", ":p": "PENDING"},
+            ReturnValues="UPDATED_OLD"
+        )
+        print("Dyanomo DB updated job status to RUNNING")
+    except ClientError as e:
+        print(e)
+        return e.response['Error']['Code'] == "ConditionalCheckFailedException"
+
+    filename = s3_key_input_file.split("/")[2]
+    input_path = annotation_folder + "/" + filename
+
+    if stream_input:
+        process, feeder = stream_job(s3_inputs_bucket, s3_key_input_file,
+                                     input_path)
+    else:
+        process, feeder = download_job(s3_inputs_bucket, s3_key_input_file,
+                                       input_path), None
+    if process is None:
+        return False
+
+    return wait_for_job(job_id, process, input_path, feeder)
+
+def download_job(s3_inputs_bucket, s3_key_input_file, input_path):
+    """
+    Download the input file and run the annotator on the local copy
+    """
     # Get the input file S3 object and copy it to a local file
-    s3 = boto3.resource("s3")
+    s3 = aws_clients.get_resource("s3", region_name)
     bucket = s3.Bucket(s3_inputs_bucket)
     try:
         s3.meta.client.head_bucket(Bucket=s3_inputs_bucket)
@@ -92,49 +135,63 @@ while True:
         error_code = e.response['Error']['Code']
         if error_code == '404':
             print(e)
-            continue
+            return None
 
-    filename = s3_key_input_file.split("/")[2]
-    f = open("annotation-files/"+filename, "w")
+    f = open(input_path, "w")
     f.close()
 
     # Try to download file from bucket
     try:
-        bucket.download_file(s3_key_input_file, 
-                            'annotation-files/' + filename)
+        bucket.download_file(s3_key_input_file, input_path)
         print("Annotation file succssfully retrieved from bucket")
     except ClientError as e:
         if e.response['Error']['Code'] == "404":
             print("The object does not exist.")
         print(e)
-        continue
+        return None
 
-    # Run the annotator using hw5_run
-    """try:
-        process = subprocess.Popen(["python", "run.py", "annotation-files/" + filename], stdout=subprocess.PIPE)
-        print("A new process was spawned to run the annotation file")
-    except subprocess.CalledProcessError as e:
-        print(e)
-        continue"""
-    
-    # Update dynamoDB to show process as running
-    try:
-        dynamo = boto3.resource('dynamodb')
-        table = dynamo.Table(dynamo_table_name)
-        response = table.update_item(
-            Key = {"job_id": job_id}, 
-            UpdateExpression="set job_status = :j",
-            ConditionExpression = "job_status = :p",
-            ExpressionAttributeValues={":j": "RUNNING", ":p": "PENDING"},
-            ReturnValues="UPDATED_OLD"
-        )
-        print("Dyanomo DB updated job status to PENDING")
+    return start_job(input_path)
 
-    # The dynamo DB won't be updated to RUNNING, but since the job is already
-    # running, the message should still be deleted
+def stream_job(s3_inputs_bucket, s3_key_input_file, input_path):
+    """
+    Run the annotator on a named pipe and stream the input file into it
+    from S3, so annotation starts on the first range instead of after the
+    whole file has been written to disk
+    """
+    s3_client = aws_clients.get_client("s3", region_name)
+    try:
+        reader = s3_stream.RangedReader(s3_client, s3_inputs_bucket,
+                                        s3_key_input_file, stream_chunk_size,
+                                        stream_read_ahead)
     except ClientError as e:
+        if e.response['Error']['Code'] == "404":
+            print("The object does not exist.")
         print(e)
-        pass
-
-    # Delete the message using its handle
-    delete_msg(queue_url, message_handle)
+        return None, None
+
+    s3_stream.create_fifo(input_path)
+    process = start_job(input_path)
+    if process is None:
+        os.remove(input_path)
+        return None, None
+
+    feeder = threading.Thread(target=s3_stream.stream_to_fifo,
+                              args=(reader, input_path, process), daemon=True)
+    feeder.start()
+    print("Streaming annotation file from bucket")
+    return process, feeder
+
+# Run up to worker_slots jobs at once. The message of a running job is kept
+# hidden with visibility heartbeats until the job completes
+consumer = sqs_consumer.SqsConsumer(
+    queue_name,
+    process_message,
+    region_name=region_name,
+    workers=worker_slots,
+    max_messages=max_messages,
+    wait_time=WaitTimeBetweenMessage,
+    visibility_timeout=visibility_timeout,
+    heartbeat_interval=heartbeat_interval,
+    name="annotator"
+)
+consumer.run()
@@ -0,0 +1,391 @@
+# batch_annotate.py
+#
+# Columnar, vectorized annotation engine
+#
+# Instead of handling one record at a time, the input is cut into windows
+# of BatchBytes bytes of whole records (tens of thousands of records each).
+# Each window is decoded with NumPy into arrays of record offsets, chromosome
+# codes, positions and allele lengths: newlines and tabs are located with
+# vectorized comparisons over the memory-mapped bytes, and positions are
+# parsed digit column by digit column. Each record is then matched to the
+# reference feature covering its position with searchsorted against the
+# feature start and end arrays of its chromosome.
+#
+# Reference features come from a BED file (chrom, start, end, name; starts
+# 0-based, ends exclusive) and are reported in an ANN=<name> INFO entry.
+# build_reference.py compiles the BED file into a directory of .npy arrays
+# once; loading that maps the arrays instead of parsing, so it takes
+# milliseconds, and concurrent annotation processes share the pages. The
+# directory is a symlink to the latest version of the index: rebuilding
+# writes a new version and switches the link over, so processes that have
+# the previous version mapped are never affected.
+# Named pipes (streamed inputs) cannot be mapped; they are read into
+# windows of whole records instead.
+##
+import os
+import glob
+import json
+import stat
+import time
+import shutil
+from collections import namedtuple
+
+import numpy as np
+
+import vcf_reader
+
+NEWLINE, TAB, HASH, ZERO = 10, 9, 35, 48
+
+# Arrays of a compiled reference, stored as <name>.npy
+FEATURE_ARRAYS = ["starts", "ends", "max_ends", "covers", "name_ids"]
+
+# Loaded references by path, as (stamp, features), reused by later jobs in
+# the same process until the reference changes
+features_cache = {}
+
+# Versions of a saved index kept on disk: the current one and the one
+# before, which processes that loaded it just before a rebuild may still
+# be opening
+KEPT_VERSIONS = 2
+
+"""Decoded window of VCF records
+Offsets are into the memory-mapped file. info_ends is where the INFO column
+ends, and so where annotations are added
+"""
+RecordBatch = namedtuple('RecordBatch', ['starts', 'ends', 'info_ends',
+    'chroms', 'chrom_codes', 'positions', 'ref_lengths', 'alt_lengths'])
+
+
+"""Reference features by chromosome, as sorted arrays
+"""
+class FeatureIndex(object):
+    def __init__(self, chroms, names):
+        # chrom -> (starts, ends, max_ends, covers, name_ids)
+        self.chroms = chroms
+        self.names = names
+
+    @staticmethod
+    def arrays(starts, ends, name_ids):
+        """
+        Sort features by start and add the running maximum of their ends
+        and the feature reaching it, so that a position covered by an
+        earlier, longer feature is still found
+        """
+        order = np.argsort(starts, kind="stable")
+        starts, ends, name_ids = starts[order], ends[order], name_ids[order]
+        max_ends = np.maximum.accumulate(ends)
+        covers = np.maximum.accumulate(
+            np.where(ends == max_ends, np.arange(len(ends)), 0))
+        return starts, ends, max_ends, covers, name_ids
+
+    @classmethod
+    def from_bed(cls, path):
+        columns = {}
+        names = []
+        with open(path) as f:
+            for line in f:
+                if not line.strip() or line.startswith(("#", "track", "browser")):
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                chrom_columns = columns.setdefault(fields[0], ([], [], []))
+                chrom_columns[0].append(int(fields[1]))
+                chrom_columns[1].append(int(fields[2]))
+                chrom_columns[2].append(len(names))
+                names.append(fields[3].encode() if len(fields) > 3 else b".")
+        chroms = {chrom: cls.arrays(np.array(starts, dtype=np.int64),
+                                    np.array(ends, dtype=np.int64),
+                                    np.array(name_ids, dtype=np.int32))
+                  for chrom, (starts, ends, name_ids) in columns.items()}
+        return cls(chroms, names)
+
+    def save(self, directory):
+        """
+        Write the index as one .npy file per array, with the features of
+        all chromosomes back to back, and their extents in chroms.json.
+        The files go to a new version directory, <directory>.v<time>, and
+        directory is then atomically replaced by a symlink to it
+        """
+        directory = directory.rstrip("/")
+        version = f"{directory}.v{time.time_ns()}"
+        os.makedirs(version)
+        extents = {}
+        offset = 0
+        for chrom in sorted(self.chroms):
+            count = len(self.chroms[chrom][0])
+            extents[chrom] = [offset, count]
+            offset += count
+        for n, name in enumerate(FEATURE_ARRAYS):
+            np.save(os.path.join(version, name + ".npy"), np.concatenate(
+                [self.chroms[chrom][n] for chrom in sorted(self.chroms)]))
+        np.save(os.path.join(version, "names.npy"),
+                np.array(self.names, dtype=bytes))
+        with open(os.path.join(version, "chroms.json"), "w") as f:
+            json.dump(extents, f)
+
+        if os.path.isdir(directory) and not os.path.islink(directory):
+            # An index saved in place, before versions were used
+            os.rename(directory, f"{directory}.v0")
+        link = version + ".link"
+        os.symlink(os.path.basename(version), link)
+        os.replace(link, directory)
+        remove_old_versions(directory)
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Map a saved index into memory; pages are read on first use
+        """
+        directory = os.path.realpath(directory)
+        arrays = [np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+                  for name in FEATURE_ARRAYS]
+        names = np.load(os.path.join(directory, "names.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "chroms.json")) as f:
+            extents = json.load(f)
+        chroms = {chrom: tuple(array[offset:offset + count] for array in arrays)
+                  for chrom, (offset, count) in extents.items()}
+        return cls(chroms, names)
+
+    def lookup(self, chrom, positions):
+        """
+        Name ids of the features covering 1-based positions, -1 for none
+        """
+        found = np.full(len(positions), -1, dtype=np.int32)
+        if chrom not in self.chroms or not len(positions):
+            return found
+        starts, ends, max_ends, covers, name_ids = self.chroms[chrom]
+        zero_based = positions - 1
+        i = np.searchsorted(starts, zero_based, side="right") - 1
+        valid = i >= 0
+        i = np.maximum(i, 0)
+        direct = valid & (ends[i] > zero_based)
+        covered = valid & ~direct & (max_ends[i] > zero_based)
+        found[direct] = name_ids[i[direct]]
+        found[covered] = name_ids[covers[i[covered]]]
+        return found
+
+
+"""INFO entries of feature names, made as they are first needed
+"""
+class Labels(dict):
+    def __init__(self, features):
+        self.features = features
+
+    def __missing__(self, name_id):
+        label = self[name_id] = b";ANN=" + bytes(self.features.names[name_id])
+        return label
+
+
+def remove_old_versions(directory):
+    """
+    Delete the versions of a saved index older than the last KEPT_VERSIONS
+    """
+    versions = sorted(glob.glob(glob.escape(directory) + ".v*"),
+                      key=lambda version: int(version.rsplit(".v", 1)[1]))
+    for version in versions[:-KEPT_VERSIONS]:
+        shutil.rmtree(version, ignore_errors=True)
+
+def reference_stamp(path):
+    """
+    Changes whenever the reference at path does: the version an index
+    directory links to, or the modification time of a BED file
+    """
+    if os.path.isdir(path):
+        return os.path.realpath(path)
+    return os.stat(path).st_mtime_ns
+
+def load_features(path):
+    """
+    Get the reference features from a compiled index directory or, more
+    slowly, a BED file. Each is only loaded once per process, and again
+    after it has been rebuilt
+    """
+    stamp = reference_stamp(path)
+    if path not in features_cache or features_cache[path][0] != stamp:
+        features_cache[path] = (stamp, FeatureIndex.load(path)
+                                if os.path.isdir(path)
+                                else FeatureIndex.from_bed(path))
+    return features_cache[path][1]
+
+def column_ends(tabs, starts, ends, columns):
+    """
+    Offsets of the tabs closing the first columns of each line (the line
+    end when a line has fewer columns)
+    """
+    first = np.searchsorted(tabs, starts)
+    bounds = []
+    for k in range(columns):
+        j = np.minimum(first + k, max(len(tabs) - 1, 0))
+        tab = tabs[j] if len(tabs) else ends
+        bounds.append(np.where((first + k < len(tabs)) & (tab < ends), tab, ends))
+    return bounds
+
+def gather(data, starts, lengths, width):
+    """
+    Bytes of each field as rows of a (records, width) array, zero padded
+    """
+    columns = np.arange(width)
+    index = np.minimum(starts[:, None] + columns, len(data) - 1)
+    return np.where(columns < lengths[:, None], data[index], 0).astype(np.uint8)
+
+def decode_batch(buf, start, end):
+    """
+    Decode the records in [start, end) of a mapped VCF file, which must
+    start at a line boundary and end after a newline or at end of file
+    """
+    data = np.frombuffer(buf, dtype=np.uint8, count=end - start, offset=start)
+    newlines = np.flatnonzero(data == NEWLINE)
+    if not len(newlines) or newlines[-1] != len(data) - 1:
+        newlines = np.append(newlines, len(data))
+    line_starts = np.concatenate(([0], newlines[:-1] + 1))
+    line_ends = newlines
+    # Drop blank lines, header lines and carriage returns
+    keep = line_ends > line_starts
+    keep[keep] = data[line_starts[keep]] != HASH
+    line_starts, line_ends = line_starts[keep], line_ends[keep]
+    line_ends = line_ends - (data[np.maximum(line_ends - 1, 0)] == ord("\r"))
+    if not len(line_starts):
+        empty = np.zeros(0, dtype=np.int64)
+        return RecordBatch(empty, empty, empty, [], empty, empty, empty, empty)
+
+    tabs = np.flatnonzero(data == TAB)
+    chrom_end, pos_end, id_end, ref_end, alt_end, _, _, info_end = \
+        column_ends(tabs, line_starts, line_ends, 8)
+
+    # POS, parsed one digit column at a time
+    pos_lengths = pos_end - chrom_end - 1
+    digits = gather(data, chrom_end + 1, pos_lengths,
+                    int(pos_lengths.max()) if len(pos_lengths) else 0)
+    positions = np.zeros(len(line_starts), dtype=np.int64)
+    for k in range(digits.shape[1]):
+        in_field = k < pos_lengths
+        positions = np.where(in_field,
+                             positions * 10 + (digits[:, k].astype(np.int64) - ZERO),
+                             positions)
+
+    # CHROM, coded by its distinct names (all of their bytes, and their
+    # length as 8 more bytes)
+    chrom_lengths = chrom_end - line_starts
+    keys = gather(data, line_starts, chrom_lengths, int(chrom_lengths.max()))
+    keys = np.concatenate([keys, chrom_lengths.astype("<i8")[:, None].view(np.uint8)],
+                          axis=1)
+    unique_keys, first_seen, chrom_codes = np.unique(
+        keys, axis=0, return_index=True, return_inverse=True)
+    chroms = [bytes(data[line_starts[i]:chrom_end[i]]).decode()
+              for i in first_seen]
+
+    return RecordBatch(
+        starts=line_starts + start,
+        ends=line_ends + start,
+        info_ends=info_end + start,
+        chroms=chroms,
+        chrom_codes=chrom_codes.reshape(-1),
+        positions=positions,
+        ref_lengths=ref_end - id_end - 1,
+        alt_lengths=alt_end - ref_end - 1
+    )
+
+def annotate_batch(batch, features):
+    """
+    Feature name ids for every record of a batch, -1 where none applies
+    """
+    found = np.full(len(batch.positions), -1, dtype=np.int32)
+    for code, chrom in enumerate(batch.chroms):
+        in_chrom = batch.chrom_codes == code
+        found[in_chrom] = features.lookup(chrom, batch.positions[in_chrom])
+    return found
+
+def write_batch(out, buf, batch, found, labels):
+    """
+    Write the records of a batch with the feature of each added to INFO.
+    Runs of records without a feature are copied as one slice each; only
+    annotated records are rebuilt
+    """
+    starts, ends = batch.starts.tolist(), batch.ends.tolist()
+    info_ends = batch.info_ends.tolist()
+    annotated = np.flatnonzero(found >= 0).tolist()
+    pieces = []
+    # First record of the current run of records without a feature
+    run_start = 0
+    for i in annotated + [len(starts)]:
+        if i > run_start:
+            pieces.append(buf[starts[run_start]:ends[i - 1]])
+        if i == len(starts):
+            break
+        start, info_end, end = starts[i], info_ends[i], ends[i]
+        label = labels[int(found[i])]
+        if buf[info_end - 2:info_end] == b"\t.":
+            # Replace an empty INFO column
+            pieces.append(buf[start:info_end - 1] + label[1:] + buf[info_end:end])
+        else:
+            pieces.append(buf[start:info_end] + label + buf[info_end:end])
+        run_start = i + 1
+    pieces.append(b"")
+    out.write(b"\n".join(pieces))
+
+def read_windows(f, batch_bytes):
+    """
+    Read a stream in windows of about batch_bytes bytes of whole lines
+    """
+    carry = b""
+    while True:
+        data = f.read(batch_bytes)
+        if not data:
+            if carry:
+                yield carry
+            return
+        data = carry + data
+        cut = data.rfind(b"\n") + 1
+        carry = data[cut:]
+        if cut:
+            yield data[:cut]
+
+def mapped_windows(path, out, batch_bytes):
+    """
+    Windows (buf, start, end) of a mapped file, after writing its header
+    """
+    with vcf_reader.VcfReader(path) as reader:
+        out.write(reader.header)
+        for start, end in reader.chunk_offsets(batch_bytes):
+            yield reader.buf, start, end
+
+def streamed_windows(path, out, batch_bytes):
+    """
+    Windows (buf, start, end) read from a named pipe, writing the header
+    lines as they are read
+    """
+    in_header = True
+    with open(path, "rb") as f:
+        for buf in read_windows(f, batch_bytes):
+            start = 0
+            if in_header:
+                start = vcf_reader.find_body(buf)
+                out.write(buf[:start])
+                in_header = start == len(buf)
+            if start < len(buf):
+                yield buf, start, len(buf)
+
+def run(path, features=None, features_path=None, batch_bytes=8 * 1024 * 1024):
+    """
+    Annotate a .vcf file, writing the same .annot.vcf and .count.log files
+    as driver.run(path, 'vcf')
+    """
+    if features is None:
+        features = load_features(features_path)
+    labels = Labels(features)
+    windows = streamed_windows if stat.S_ISFIFO(os.stat(path).st_mode) \
+        else mapped_windows
+
+    records = annotated = 0
+    with open(path[:-3] + "annot." + path[-3:], "wb") as out:
+        for buf, start, end in windows(path, out, batch_bytes):
+            batch = decode_batch(buf, start, end)
+            found = annotate_batch(batch, features)
+            write_batch(out, buf, batch, found, labels)
+            records += len(found)
+            annotated += int((found >= 0).sum())
+
+    with open(path + ".count.log", "w") as f:
+        f.write(f"Total number of records: {records}\n")
+        f.write(f"Annotated records: {annotated}\n")
+
+### EOF
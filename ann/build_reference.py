@@ -0,0 +1,33 @@
+# build_reference.py
+#
+# Compiles annotation reference features into a memory-mappable index
+#
+# Usage: python build_reference.py <features.bed> <index directory>
+#
+# Run once whenever the reference data changes, and point ReferenceFeatures
+# in ann_config.ini at the index directory. The directory is a symlink to
+# the latest version, so this can be rerun while annotators are running:
+# jobs started afterwards pick up the new index.
+##
+import sys
+import time
+
+import batch_annotate
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python build_reference.py <features.bed> <index directory>")
+        sys.exit(1)
+
+    start = time.time()
+    features = batch_annotate.FeatureIndex.from_bed(sys.argv[1])
+    features.save(sys.argv[2])
+    print(f"Indexed {len(features.names)} features on " \
+          f"{len(features.chroms)} chromosomes in {time.time() - start:.2f} seconds")
+
+    # Check that the index maps back
+    start = time.time()
+    batch_annotate.FeatureIndex.load(sys.argv[2])
+    print(f"Index loads in {(time.time() - start) * 1000:.1f} ms")
+
+### EOF
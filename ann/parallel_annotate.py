@@ -0,0 +1,140 @@
+# parallel_annotate.py
+#
+# Runs AnnTools over a VCF file on several cores
+#
+# The body of the input is split into chunks of whole records (found by
+# scanning the memory-mapped file, see vcf_reader.py). Each chunk is
+# written out behind the header, which is read once, and annotated by
+# driver.run in its own process. The annotated chunks are then merged in
+# order into the .annot.vcf that driver.run would have written for the
+# whole file, and their count logs are added up into its .count.log.
+# Small inputs, streamed (FIFO) inputs and a single worker fall back to a
+# single driver.run call. Another engine with the same interface (e.g.
+# batch_annotate.run) can be used in place of driver.run.
+##
+import os
+import re
+import stat
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import driver
+import vcf_reader
+
+# "<label>: <number>" lines of a count log, which are summed over chunks
+COUNT_LINE = re.compile(r"^(?P<label>[^:]*:\s*)(?P<count>\d+)\s*$")
+
+
+def annot_path(path):
+    """
+    Where driver.run writes the annotated version of a .vcf file
+    """
+    return path[:-3] + "annot." + path[-3:]
+
+def count_log_path(path):
+    return path + ".count.log"
+
+def run_anntools(path):
+    driver.run(path, 'vcf')
+
+def annotate_chunk(annotate, path, header, start, end, chunk_path):
+    """
+    Write one chunk behind the header and annotate it (in a pool process)
+    """
+    with open(path, "rb") as src, open(chunk_path, "wb") as dst:
+        dst.write(header)
+        src.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = src.read(min(remaining, 1024 * 1024))
+            if not data:
+                break
+            dst.write(data)
+            remaining -= len(data)
+    annotate(chunk_path)
+    os.remove(chunk_path)
+    return chunk_path
+
+def merge_outputs(chunk_paths, output_path):
+    """
+    Concatenate annotated chunks in order, keeping only the first header
+    """
+    with open(output_path, "wb") as out:
+        for n, chunk_path in enumerate(chunk_paths):
+            with open(annot_path(chunk_path), "rb") as f:
+                for line in f:
+                    if n == 0 or not line.startswith(b"#"):
+                        out.write(line)
+                        break
+                shutil.copyfileobj(f, out)
+            os.remove(annot_path(chunk_path))
+
+def merge_count_logs(chunk_paths, output_path):
+    """
+    Add up "<label>: <number>" lines across the chunks' count logs; other
+    lines are taken from the first chunk's log
+    """
+    merged = None
+    for chunk_path in chunk_paths:
+        with open(count_log_path(chunk_path)) as f:
+            lines = f.read().splitlines()
+        os.remove(count_log_path(chunk_path))
+        if merged is None:
+            merged = lines
+            continue
+        for i, line in enumerate(lines[:len(merged)]):
+            total, count = COUNT_LINE.match(merged[i]), COUNT_LINE.match(line)
+            if total and count and total.group("label") == count.group("label"):
+                merged[i] = total.group("label") + \
+                    str(int(total.group("count")) + int(count.group("count")))
+    with open(output_path, "w") as f:
+        f.write("\n".join(merged or []) + "\n")
+
+def remove_chunk_files(chunk_paths):
+    """
+    Delete whatever is left of the chunks of a run, e.g. after a failure
+    """
+    for chunk_path in chunk_paths:
+        for leftover in (chunk_path, annot_path(chunk_path),
+                         count_log_path(chunk_path)):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+def run(path, workers=None, chunk_size=64 * 1024 * 1024, annotate=run_anntools):
+    """
+    Annotate a .vcf file like driver.run(path, 'vcf'), using up to workers
+    processes (all cores by default). annotate is called with the path of
+    each chunk and must be picklable
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or stat.S_ISFIFO(os.stat(path).st_mode) or \
+            os.path.getsize(path) <= chunk_size:
+        annotate(path)
+        return
+
+    with vcf_reader.VcfReader(path) as reader:
+        header = reader.header
+        offsets = reader.chunk_offsets(chunk_size)
+    chunk_paths = [f"{path[:-4]}.part{n:05d}.vcf" for n in range(len(offsets))]
+    print(f"Annotating {path} in {len(offsets)} chunks on {workers} processes")
+
+    try:
+        with ProcessPoolExecutor(max_workers=min(workers, len(offsets))) as executor:
+            futures = [executor.submit(annotate_chunk, annotate, path, header,
+                                       start, end,
+                                       chunk_path)
+                       for (start, end), chunk_path in zip(offsets, chunk_paths)]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Chunks not started yet are pointless once one has failed
+                executor.shutdown(cancel_futures=True)
+                raise
+
+        merge_outputs(chunk_paths, annot_path(path))
+        merge_count_logs(chunk_paths, count_log_path(path))
+    finally:
+        remove_chunk_files(chunk_paths)
+
+### EOF
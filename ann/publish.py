@@ -0,0 +1,121 @@
+# publish.py
+#
+# Uploads annotation results to S3
+#
+# All result files of a job are uploaded at the same time, each as a tuned
+# multipart transfer, and may be compressed on the fly while uploading.
+# BGZF compressed files can be indexed as they are compressed; the index is
+# uploaded next to them (see util/result_index.py).
+##
+import sys
+import time
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+
+sys.path.append("../util")
+import bgzf
+import result_index
+
+# Key suffix added to result files for each supported compression
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "bgzip": ".gz"}
+
+MB = 1024 * 1024
+
+
+"""Compresses a file while it is being read
+Lets S3 upload compressed data without writing a compressed copy to disk
+"""
+class CompressingReader(object):
+    def __init__(self, fileobj, compression, read_size=MB, indexer=None):
+        self.fileobj = fileobj
+        self.read_size = read_size
+        if compression == "gzip":
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif compression == "bgzip":
+            self.compressor = bgzf.BgzfCompressor(
+                on_block=indexer.add_block if indexer else None)
+        else:
+            raise ValueError(f"Unsupported compression: {compression}")
+        self.buffer = b""
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.fileobj.read(self.read_size)
+            if data:
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.eof = True
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+"""Counts bytes reported by S3 transfer progress callbacks
+"""
+class ProgressCounter(object):
+    def __init__(self):
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self.lock:
+            self.bytes += bytes_amount
+
+
+def transfer_config(config):
+    """
+    Build the multipart transfer settings from the [run] config section
+    """
+    return TransferConfig(
+        multipart_threshold=int(config["MultipartThreshold"]),
+        multipart_chunksize=int(config["MultipartChunkSize"]),
+        max_concurrency=int(config["MaxConcurrency"]),
+        use_threads=True
+    )
+
+def upload_file(s3_client, bucket_name, local_file, key, compression, config,
+                index=False):
+    """
+    Upload one file, optionally compressing it, and report its throughput.
+    With index set, a BGZF file's block index is uploaded as well
+    """
+    progress = ProgressCounter()
+    indexer = result_index.ResultIndexer() \
+        if index and compression == "bgzip" else None
+    extra_args = {} if compression == "none" else \
+        {"ContentType": "application/gzip"}
+    with open(local_file, "rb") as f:
+        body = f if compression == "none" else \
+            CompressingReader(f, compression, indexer=indexer)
+        timer = time.time()
+        s3_client.upload_fileobj(body, bucket_name, key, ExtraArgs=extra_args,
+                                 Config=config, Callback=progress)
+        secs = max(time.time() - timer, 1e-6)
+    print(f"Uploaded {key}: {progress.bytes / MB:.2f} MB in {secs:.2f} " \
+          f"seconds ({progress.bytes / MB / secs:.2f} MB/s)")
+
+    if indexer:
+        s3_client.put_object(Bucket=bucket_name,
+                             Key=key + result_index.INDEX_SUFFIX,
+                             Body=indexer.to_json().encode(),
+                             ContentType="application/json")
+
+def upload_results(s3_client, bucket_name, uploads, config):
+    """
+    Upload several files at the same time. Each upload is a
+    (local_file, key, compression, index) tuple; the first failure is raised
+    """
+    with ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+        futures = [executor.submit(upload_file, s3_client, bucket_name,
+                                   local_file, key, compression, config, index)
+                   for local_file, key, compression, index in uploads]
+        for future in futures:
+            future.result()
+
+### EOF
@@ -8,14 +8,16 @@ import sys
 import os
 import time
 from botocore.exceptions import ClientError
-import boto3
 import json
+import functools
 from configparser import ConfigParser
 
 sys.path.append("../util")
 import helpers
+import aws_clients
 sys.path.append("anntools")
-import driver
+import publish
+import parallel_annotate
 
 """A rudimentary timer for coarse-grained profiling
 """
@@ -33,102 +35,150 @@ class Timer(object):
         if self.verbose:
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
-if __name__ == '__main__':
-    # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
-            # Get util configuration
-            config = ConfigParser(os.environ)
-            config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
-            dynamo_table_name = config["run"]["AWS_DYNAMODB_ANNOTATIONS_TABLE"]
-
-            filepath = sys.argv[1]
-            filename = filepath.split("/")[1]
-            job_id = filename.split("~")[0]
-
-            try:
-                dynamo = boto3.resource('dynamodb')
-                table = dynamo.Table(dynamo_table_name)
-                response = table.get_item(Key = {'job_id': job_id })
-                annotation = response["Item"]
-            except ClientError as e:
-                app.logger.info(f"An Error was encountered when querying dynamoDB: {e}")
+def annotation_engine(config):
+    """
+    The function annotating a .vcf file, as configured; reference data of
+    the batch engine is loaded here, once per process
+    """
+    if config["run"]["AnnotationEngine"] == "batch":
+        import batch_annotate
+        batch_annotate.load_features(config["run"]["ReferenceFeatures"])
+        return functools.partial(
+            batch_annotate.run,
+            features_path=config["run"]["ReferenceFeatures"],
+            batch_bytes=int(config["run"]["BatchBytes"])
+        )
+    return parallel_annotate.run_anntools
+
+def annotation_workers(config):
+    """
+    Processes annotating one file; by default the cores are shared out
+    between the WorkerSlots jobs the annotator runs at once
+    """
+    workers = int(config["run"]["AnnotationWorkers"])
+    if workers:
+        return workers
+    return max(1, (os.cpu_count() or 1) // int(config["ann"]["WorkerSlots"]))
+
+def run_job(input_path):
+    """
+    Annotate an input file, upload the results and mark the job COMPLETED.
+    Exits with a non-zero status if the job could not be completed
+    """
+    with Timer():
+        # Get util configuration
+        config = ConfigParser(os.environ)
+        config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
+
+        # Annotate on several cores; small files run in one process
+        parallel_annotate.run(
+            input_path,
+            workers=annotation_workers(config),
+            chunk_size=int(config["run"]["AnnotationChunkSize"]),
+            annotate=annotation_engine(config)
+        )
+        dynamo_table_name = config["run"]["AWS_DYNAMODB_ANNOTATIONS_TABLE"]
+
+        filepath = input_path
+        filename = filepath.split("/")[1]
+        job_id = filename.split("~")[0]
+
+        try:
+            table = aws_clients.get_table(dynamo_table_name)
+            response = table.get_item(Key = {'job_id': job_id })
+            annotation = response["Item"]
+        except ClientError as e:
+            print(f"An Error was encountered when querying dynamoDB: {e}")
+            sys.exit(1)
+
+        s3 = aws_clients.get_resource("s3")
+        aws_prefix = config["run"]["AWS_S3_KEY_PREFIX"]
+        bucket_name = config["run"]["AWS_S3_RESULTS_BUCKET"]
+
+        exists = True
+        bucket = s3.Bucket(bucket_name)
+        try:
+            s3.meta.client.head_bucket(Bucket=bucket_name)
+        except ClientError as e:
+            # If a client error is thrown, then check that it was a 404 error.
+            # If it was a 404 error, then the bucket does not exist.
+            error_code = e.response['Error']['Code']
+            if error_code == '404':
+                exists = False
+                raise e
             
-            s3 = boto3.resource("s3")
-            aws_prefix = config["run"]["AWS_S3_KEY_PREFIX"]
-            bucket_name = config["run"]["AWS_S3_RESULTS_BUCKET"]
-
-            exists = True
-            bucket = s3.Bucket(bucket_name)
-            try:
-                s3.meta.client.head_bucket(Bucket=bucket_name)
-            except ClientError as e:
-                # If a client error is thrown, then check that it was a 404 error.
-                # If it was a 404 error, then the bucket does not exist.
-                error_code = e.response['Error']['Code']
-                if error_code == '404':
-                    exists = False
-                    raise e
-            
-            local_countlog_file = filepath+".count.log"
-            local_annot_file = filepath[:-3] + "annot." + filepath[-3:]
-
-            bucket_countlog_file = aws_prefix + annotation["user_id"] + "/" + \
-                local_countlog_file.split("/")[1]
-            bucket_annot_file = aws_prefix + annotation["user_id"] + "/" + \
-                local_annot_file.split("/")[1]
-
-            bucket.upload_file(local_countlog_file, bucket_countlog_file)
-            bucket.upload_file(local_annot_file, bucket_annot_file)
-
-            os.remove(local_countlog_file)
-            os.remove(local_annot_file)
-            os.remove(filepath)
+        local_countlog_file = filepath+".count.log"
+        local_annot_file = filepath[:-3] + "annot." + filepath[-3:]
+
+        bucket_countlog_file = aws_prefix + annotation["user_id"] + "/" + \
+            local_countlog_file.split("/")[1]
+        bucket_annot_file = aws_prefix + annotation["user_id"] + "/" + \
+            local_annot_file.split("/")[1]
+
+        # Upload the results file and the count log at the same time,
+        # compressing the results file as it is uploaded if configured;
+        # BGZF results are indexed for region queries
+        compression = config["run"]["ResultsCompression"]
+        bucket_annot_file += publish.COMPRESSION_SUFFIXES[compression]
+        publish.upload_results(
+            s3.meta.client,
+            bucket_name,
+            [(local_annot_file, bucket_annot_file, compression, True),
+             (local_countlog_file, bucket_countlog_file, "none", False)],
+            publish.transfer_config(config["run"])
+        )
+
+        os.remove(local_countlog_file)
+        os.remove(local_annot_file)
+        os.remove(filepath)
             
-            # Update dynamoDB status to complete and update complete time
-            dynamo_table_name = config["run"]["AWS_DYNAMODB_ANNOTATIONS_TABLE"]
-            try:
-                dynamo = boto3.resource('dynamodb')
-                table = dynamo.Table(dynamo_table_name)
-                response = table.update_item(
-                    Key = {"job_id": job_id},
-                    UpdateExpression="""set job_status = :j,
-                                        complete_time = :t,
-                                        s3_key_result_file = :rf,
-                                        s3_key_log_file = :lf
-                                        """,
-                    ExpressionAttributeValues= {":j": "COMPLETED",
-                                                ":t": int(time.time()),                                               
-                                                ":rf": bucket_annot_file,
-                                                ":lf": bucket_countlog_file
-                                                },
-                    ReturnValues="UPDATED_OLD"
-                )
-            except ClientError as e:
-                print(e)
-            print("Dynamo DB Updated to Completed")
-
-            # Get SNS Topic ARN from config
-            sns_topic_arn = config["run"]["AWS_SNS_JOB_COMPLETE_TOPIC"]
-
-            # Send message to request queue
-            try:
-                print()
-                email = {
-                    "email":helpers.get_user_profile(id=annotation["user_id"])[2],
-                    "job_id":job_id
-                }
-                sns = boto3.client("sns")
-                sns.publish(
-                    TopicArn=sns_topic_arn,
-                    MessageStructure="json",
-                    Message=json.dumps({'default': json.dumps(email)}),
-                    Subject="Your GAS task has been completed"
-                )
-            except ClientError as e:
-                print(e)
-            print("Complete Topic SNS published")
+        # Update dynamoDB status to complete and update complete time
+        dynamo_table_name = config["run"]["AWS_DYNAMODB_ANNOTATIONS_TABLE"]
+        try:
+            table = aws_clients.get_table(dynamo_table_name)
+            response = table.update_item(
+                Key = {"job_id": job_id},
+                UpdateExpression="""set job_status = :j,
+                                    complete_time = :t,
+                                    s3_key_result_file = :rf,
+                                    s3_key_log_file = :lf
+                                    """,
+                ExpressionAttributeValues= {":j": "COMPLETED",
+                                            ":t": int(time.time()),                                               
+                                            ":rf": bucket_annot_file,
+                                            ":lf": bucket_countlog_file
+                                            },
+                ReturnValues="UPDATED_OLD"
+            )
+        except ClientError as e:
+            # Exit non-zero so the annotator keeps the job's message
+            # and the job is retried
+            print(e)
+            sys.exit(1)
+        print("Dynamo DB Updated to Completed")
+
+        # Get SNS Topic ARN from config
+        sns_topic_arn = config["run"]["AWS_SNS_JOB_COMPLETE_TOPIC"]
+
+        # Send message to request queue
+        try:
+            print()
+            email = {
+                "email":helpers.get_user_profile(id=annotation["user_id"])[2],
+                "job_id":job_id
+            }
+            sns = aws_clients.get_client("sns")
+            sns.publish(
+                TopicArn=sns_topic_arn,
+                MessageStructure="json",
+                Message=json.dumps({'default': json.dumps(email)}),
+                Subject="Your GAS task has been completed"
+            )
+        except ClientError as e:
+            print(e)
+        print("Complete Topic SNS published")
+        # In sweep mode the archive utility finds expired results itself
+        if config["run"]["ArchiveMode"] == "message":
             sns_topic_arn = config["run"]["AWS_SNS_ARCHIVE_TOPIC"]
 
             # Send message to delayed archive queue
@@ -138,7 +188,7 @@ if __name__ == '__main__':
                     "result_file_key": bucket_annot_file,
                     "job_id": job_id
                 }
-                sns = boto3.client("sns")
+                sns = aws_clients.get_client("sns")
                 sns.publish(
                     TopicArn=sns_topic_arn,
                     MessageStructure="json",
@@ -148,7 +198,12 @@ if __name__ == '__main__':
             except ClientError as e:
                 print(e)
             print("Archive Topic SNS published")
-        print("run finished running")
+    print("run finished running")
+
+if __name__ == '__main__':
+    # Call the AnnTools pipeline
+    if len(sys.argv) > 1:
+        run_job(sys.argv[1])
     else:
         print("A valid .vcf file must be provided as input to this program.")
 
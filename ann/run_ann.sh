@@ -2,4 +2,8 @@ cd /home/ec2-user/mpcs-cc
 source bin/activate
 cd gas/ann
 mkdir annotation-files
+# Warm annotation server (ann_server.py), restarted whenever it exits; jobs
+# fall back to spawning run.py while it is down. Stopped with the annotator
+trap "kill 0" EXIT
+(while true; do python3 ann_server.py; sleep 5; done) &
 python3 annotator.py
\ No newline at end of file
@@ -0,0 +1,97 @@
+# s3_stream.py
+#
+# Streams annotation input files from S3 into the AnnTools pipeline
+#
+# The object is read with ranged GET requests, a few ranges ahead of the
+# reader, and written into a named pipe that run.py opens in place of a
+# downloaded file. Annotation starts as soon as the first range arrives.
+##
+import os
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+"""Iterates over an S3 object in fixed-size ranges, fetched ahead of use
+"""
+class RangedReader(object):
+    def __init__(self, s3_client, bucket, key, chunk_size, read_ahead):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+
+        # Pin every range to the same version of the object
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+        self.size = head["ContentLength"]
+        self.etag = head["ETag"]
+
+    def get_range(self, start):
+        end = min(start + self.chunk_size, self.size) - 1
+        response = self.s3_client.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Range=f"bytes={start}-{end}",
+            IfMatch=self.etag
+        )
+        return response["Body"].read()
+
+    def __iter__(self):
+        offsets = iter(range(0, self.size, self.chunk_size))
+        with ThreadPoolExecutor(max_workers=self.read_ahead) as executor:
+            pending = deque(executor.submit(self.get_range, start)
+                            for start in itertools.islice(offsets, self.read_ahead))
+            while pending:
+                chunk = pending.popleft().result()
+                start = next(offsets, None)
+                if start is not None:
+                    pending.append(executor.submit(self.get_range, start))
+                yield chunk
+
+
+def create_fifo(path):
+    """
+    Create the named pipe run.py reads its input from, replacing any file
+    left behind by an earlier attempt at the same job
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    os.mkfifo(path)
+
+def stream_to_fifo(reader, fifo_path, process):
+    """
+    Feed an S3 object into the pipe read by a run.py process. If the stream
+    breaks the process is killed before the pipe is closed, so it never
+    reads end of file on a truncated input and reports it as complete
+    """
+    fifo = None
+    try:
+        fifo = open(fifo_path, "wb")
+        for chunk in reader:
+            fifo.write(chunk)
+        fifo.close()
+    except (BotoCoreError, ClientError, OSError) as e:
+        print(f"Unable to stream {reader.key}: {e}")
+        process.kill()
+        if fifo is not None:
+            try:
+                fifo.close()
+            except OSError:
+                pass
+        return
+    print(f"Streamed {reader.size} bytes of {reader.key}")
+
+def release_fifo(fifo_path):
+    """
+    Unblock a writer still waiting for run.py to open the pipe, e.g. when
+    run.py exited before reading its input
+    """
+    try:
+        os.close(os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
+
+### EOF
@@ -0,0 +1,70 @@
+# vcf_reader.py
+#
+# Memory-mapped VCF file splitting
+#
+# The input file is mapped rather than read, and the end of its header and
+# record boundaries are found with bytes.find over the mapping, which scans
+# in C (memchr), so no per-line str objects are created. The records
+# themselves are decoded in bulk by batch_annotate.py, or by AnnTools.
+##
+import mmap
+
+
+def find_body(buf):
+    """
+    Offset of the first line of buf that is not a '#' header line
+    """
+    offset = 0
+    while offset < len(buf) and buf[offset:offset + 1] == b"#":
+        newline = buf.find(b"\n", offset)
+        offset = len(buf) if newline < 0 else newline + 1
+    return offset
+
+
+"""Memory-mapped reader of a VCF file
+header holds the '#' lines as bytes
+"""
+class VcfReader(object):
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            self.buf = b""
+        self.size = len(self.buf)
+        self.body_offset = self.find_body()
+
+    def find_body(self):
+        return find_body(self.buf)
+
+    @property
+    def header(self):
+        return self.buf[:self.body_offset]
+
+    def chunk_offsets(self, chunk_size):
+        """
+        Split the body into (start, end) ranges of about chunk_size bytes
+        that each hold whole records
+        """
+        offsets = []
+        start = self.body_offset
+        while start < self.size:
+            newline = self.buf.find(b"\n", min(start + chunk_size, self.size) - 1)
+            end = self.size if newline < 0 else newline + 1
+            offsets.append((start, end))
+            start = end
+        return offsets
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+### EOF
@@ -0,0 +1,104 @@
+# aio_consumer.py
+#
+# asyncio runtime for the SQS consumer
+#
+# The utility daemons spend nearly all their time waiting on SQS, S3,
+# Glacier and DynamoDB. Here a single event loop coordinates the work:
+# several long polls are kept open at once so a backlog drains at more
+# than 10 messages per round trip, and every blocking boto3 call (the
+# receives, the handlers, batched deletes and heartbeats) runs on a thread
+# of the loop's executor, so dozens of messages can be in flight in one
+# process. Handlers are the same plain functions the threaded consumer
+# runs.
+##
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from sqs_consumer import SqsConsumer
+
+
+"""Consumes an SQS queue from an asyncio event loop
+Takes the same arguments as SqsConsumer; workers is the number of messages
+handled at once
+"""
+class AsyncSqsConsumer(SqsConsumer):
+    async def claim(self):
+        """
+        Wait for idle workers and claim up to one receive's worth of them
+        """
+        while self.reserved >= self.workers and not self.stopping.is_set():
+            self.capacity.clear()
+            await self.capacity.wait()
+        count = min(self.max_messages, self.workers - self.reserved)
+        self.reserved += count
+        return count
+
+    def release(self, count):
+        self.reserved -= count
+        self.capacity.set()
+
+    async def handle_async(self, message):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.handle, message)
+        finally:
+            self.release(1)
+
+    async def poll(self):
+        """
+        One long-poll loop; several run side by side
+        """
+        loop = asyncio.get_running_loop()
+        while not self.stopping.is_set():
+            count = await self.claim()
+            if self.stopping.is_set():
+                self.release(count)
+                break
+
+            messages = await loop.run_in_executor(None, self.receive, count)
+            self.release(count - len(messages))
+            for message in messages:
+                with self.lock:
+                    self.in_flight.add(message["ReceiptHandle"])
+                task = asyncio.ensure_future(self.handle_async(message))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def housekeeping_async(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.housekeeping)
+
+    def stop(self, *args):
+        super(AsyncSqsConsumer, self).stop(*args)
+        self.capacity.set()
+
+    async def run_async(self):
+        loop = asyncio.get_running_loop()
+        # One thread per message being handled, per open long poll, and
+        # one for housekeeping
+        pollers = -(-self.workers // self.max_messages)
+        loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=self.workers + pollers + 1))
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop)
+
+        self.capacity = asyncio.Event()
+        self.reserved = 0
+        self.tasks = set()
+
+        housekeeper = asyncio.ensure_future(self.housekeeping_async())
+        await asyncio.gather(*[self.poll() for _ in range(pollers)])
+
+        # Let in-flight messages finish before the final deletes
+        if self.tasks:
+            await asyncio.gather(*list(self.tasks))
+        self.drained.set()
+        await housekeeper
+        await loop.run_in_executor(None, self.flush_acks)
+        self.metrics.report()
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+### EOF
@@ -9,13 +9,20 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import sys
-import json
-import boto3
-from botocore.exceptions import ClientError
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import BotoCoreError, ClientError
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import aws_clients
+import sqs_consumer
+import glacier_transfer
+import result_index
 
 # Add utility code here
 from configparser import ConfigParser
@@ -25,158 +32,271 @@ config.read('archive_config.ini')
 """
 ## ------------------------- HELPER FUNCTIONS -------------------------------##
 """
-def receive_message(url):
-    try:
-        response = sqs_client.receive_message(
-            QueueUrl=url,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=int(config["aws"]["WaitTimeBetweenMessage"])
-        )
-    except ClientError as e:
-        print(e)
-        return None
-    messages = response.get("Messages", [])
-    print(f"Number of messages received: {len(messages)}")
-    if len(messages) > 0:
-        return messages[0]
-    return None
-
-def parse_response(response):
-    print(response)
-    try:
-        json_response = json.loads(response)
-        json_body = json.loads(json_response["Message"])
-        return json_body
-    except Exception as e:
-        print("Parse Error")
-        print(e)
-        return None
-
-def archive_file(result_file_key):
-    s3 = boto3.client("s3", region_name = region_name)
+def upload_result(result_file_key):
+    """
+    Stream a result file from S3 to Glacier; returns its archive id, or
+    None if it could not be archived
+    """
+    s3 = aws_clients.get_client("s3", region_name)
     s3_result_bucket = config["aws"]["AwsS3ResultsBucket"]
     print(result_file_key)
-    # Try to download file from bucket
-    file_data = ""
+    # Try to open the file in the bucket
     try:
-        #Create a file object using the bucket and object key. 
         fileobj = s3.get_object(
             Bucket=s3_result_bucket,
             Key=result_file_key
         )
-        # open the file object and read it into the variable filedata. 
-        file_data = fileobj['Body'].read()
-        print("Annotation file content retrieved from bucket:")
-        print(file_data)
     except ClientError as e:
         print(f"Unable to read result data file: {e}")
         return None
 
-    # Try to move data to glacier
+    # Try to stream the data to glacier, part by part
     glacier_name = config["aws"]["AwsGlacierVault"]
     try:
-        glacier_client = boto3.client('glacier')
-        response = glacier_client.upload_archive(vaultName=glacier_name, body=file_data)
-        print("Glacier Response:")
-        print(response)
-        file_archive_id = response["archiveId"]
-    except ClientError as e:
+        glacier_client = aws_clients.get_client('glacier', region_name)
+        file_archive_id = glacier_transfer.upload_archive_stream(
+            glacier_client, glacier_name, fileobj['Body'],
+            fileobj['ContentLength'])
+        print(f"Archived {result_file_key} to Glacier as {file_archive_id}")
+    except (BotoCoreError, ClientError, IOError) as e:
         print(f"Unable to upload data file to glacier: {e}")
         return None
+    finally:
+        fileobj['Body'].close()
+    return file_archive_id
+
+def with_index_keys(result_file_keys):
+    """
+    The result files with the block indexes stored next to them
+    """
+    return [key for result_file_key in result_file_keys
+            for key in (result_file_key,
+                        result_file_key + result_index.INDEX_SUFFIX)]
 
-    # Delete file from bucket if item moved to glacier
+def archive_file(result_file_key):
+    file_archive_id = upload_result(result_file_key)
+    if not file_archive_id:
+        return None
+
+    # Delete file and its block index from bucket if item moved to glacier
+    s3 = aws_clients.get_client("s3", region_name)
     try:
-        response = s3.delete_object(
-            Bucket = s3_result_bucket,
-            Key=result_file_key
+        response = s3.delete_objects(
+            Bucket = config["aws"]["AwsS3ResultsBucket"],
+            Delete={
+                "Objects": [{"Key": key} for key in with_index_keys([result_file_key])],
+                "Quiet": True
+            }
         )
         print("Delete File Response:")
         print(response)
     except ClientError as e:
         print(f"Unable to delete result data file: {e}")
         return None
+    if response.get("Errors"):
+        print(f"Unable to delete result data file: {response['Errors']}")
+        return None
     
     return file_archive_id
 
-def delete_msg(url, handle):
-    try:
-        response = sqs_client.delete_message(
-            QueueUrl=url,
-            ReceiptHandle=handle,
-        )
-        messageID = response["ResponseMetadata"]["RequestId"]
-        print("message deleted")
-    except ClientError as e:
-        print(e)
-
-"""
-## ---------------------------- MAIN LOOP ------------------------------------##
-"""
-# Fetch item from config file
-region_name = config["aws"]['AwsRegionName']
-sqs_queue_name = config["aws"]['AwsSqsArchive']
-dynamo_table_name = config["aws"]["AwsDynamodbAnnotationsTable"]
-
-try:
-    sqs_client = boto3.client("sqs", region_name = region_name)
-    queue_url = sqs_client.get_queue_url(QueueName=sqs_queue_name)["QueueUrl"]
-except ClientError as e:
-    print("Error Here")
-    print(e)
-    raise e
-
-# Main Loop
-# Add utility code here
-
-while True:
-    # Long poll for message on provided SQS queue, if no response, continue
-    response = receive_message(queue_url)
-    if response == None:
-        continue
-    
-    message_handle = response["ReceiptHandle"]
-    message_body = response["Body"]
-
-    # If json_data is not successfully parsed, continue
-    json_data = parse_response(message_body)
-    if json_data == None:
-        continue
-    
+def handle_archive_message(json_data):
+    """
+    Archive a free user's result file; returns True once the message can
+    be deleted
+    """
     # Remove file from S3 and add to Glacier
     user_id = json_data["user_id"]
     result_file_key = json_data["result_file_key"]
     job_id = json_data["job_id"]
 
-    # Check if user is a premium user, delete message and move on
-    if helpers.get_user_profile(id=user_id)[4] == "premium_user":
-        delete_msg(queue_url, message_handle)
-        continue
+    # Only free users' results are archived; delete the message otherwise
+    role = helpers.get_roles([user_id]).get(user_id)
+    if role != "free_user":
+        if role is None:
+            print(f"No profile found for user {user_id}")
+        return True
 
     # If user is a free user, archive the data
     file_archive_id = archive_file(result_file_key)
     if not file_archive_id:
-        print(response)
-        continue
+        return False
 
-    # Update dynamoDB to show process as running
+    # Update dynamoDB with the archive id of the result file
     try:
-        dynamo = boto3.resource('dynamodb')
-        table = dynamo.Table(dynamo_table_name)
-        response = table.update_item(
+        table = aws_clients.get_table(dynamo_table_name, region_name)
+        table.update_item(
             Key = {"job_id": job_id}, 
             UpdateExpression="set results_file_archive_id = :j",
             ExpressionAttributeValues={":j": file_archive_id},
             ReturnValues="UPDATED_OLD"
         )
         print(f"Added file archive id {file_archive_id} to DynamoDB.")
-
-    # The dynamo DB won't be updated to RUNNING, but since the job is already
-    # running, the message should still be deleted
     except ClientError as e:
         print(e)
-        continue
+        return False
+
+    return True
+
+def find_expired_jobs(segment, total_segments, cutoff):
+    """
+    Scan one segment of the annotations table for completed jobs that
+    finished before cutoff and have not been archived
+    """
+    table = aws_clients.get_table(dynamo_table_name, region_name)
+    scan = {
+        "FilterExpression": Attr("job_status").eq("COMPLETED") &
+            Attr("complete_time").lte(cutoff) &
+            Attr("results_file_archive_id").not_exists(),
+        "ProjectionExpression": "job_id, user_id, s3_key_result_file",
+        "Segment": segment,
+        "TotalSegments": total_segments
+    }
+    jobs = []
+    while True:
+        response = table.scan(**scan)
+        jobs.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            return jobs
+        scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+def save_archive_ids(archived):
+    """
+    Record the archive ids of (job, archive id) pairs, in transactions of
+    up to 25 updates. Archives whose transaction fails are deleted again,
+    as their results stay in S3 for the next sweep. Returns the archived
+    jobs that were recorded
+    """
+    dynamo = aws_clients.get_client("dynamodb", region_name)
+    glacier_client = aws_clients.get_client("glacier", region_name)
+    saved = []
+    for i in range(0, len(archived), 25):
+        batch = archived[i:i + 25]
+        try:
+            dynamo.transact_write_items(TransactItems=[{
+                "Update": {
+                    "TableName": dynamo_table_name,
+                    "Key": {"job_id": {"S": job["job_id"]}},
+                    "UpdateExpression": "set results_file_archive_id = :a",
+                    "ConditionExpression": "attribute_not_exists(results_file_archive_id)",
+                    "ExpressionAttributeValues": {":a": {"S": file_archive_id}}
+                }
+            } for job, file_archive_id in batch])
+            saved.extend(job for job, _ in batch)
+        except ClientError as e:
+            print(f"Unable to record archive ids: {e}")
+            for _, file_archive_id in batch:
+                try:
+                    glacier_client.delete_archive(
+                        vaultName=config["aws"]["AwsGlacierVault"],
+                        archiveId=file_archive_id)
+                except ClientError as e:
+                    print(e)
+    return saved
+
+def delete_results(result_file_keys):
+    """
+    Delete archived result files and their indexes from S3, 1000 per request
+    """
+    s3 = aws_clients.get_client("s3", region_name)
+    result_file_keys = with_index_keys(result_file_keys)
+    for i in range(0, len(result_file_keys), 1000):
+        try:
+            response = s3.delete_objects(
+                Bucket=config["aws"]["AwsS3ResultsBucket"],
+                Delete={
+                    "Objects": [{"Key": key}
+                                for key in result_file_keys[i:i + 1000]],
+                    "Quiet": True
+                }
+            )
+        except ClientError as e:
+            print(f"Unable to delete result data files: {e}")
+            continue
+        for error in response.get("Errors", []):
+            print(f"Unable to delete result data file: {error}")
+
+def sweep():
+    """
+    Archive every free user result whose retention period has passed: a
+    parallel table scan, one role query for all users, parallel uploads to
+    Glacier, batched DynamoDB updates and S3 deletes
+    """
+    segments = int(config["aws"]["SweepSegments"])
+    cutoff = int(time.time()) - int(config["aws"]["FreeUserDataRetention"])
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        scans = executor.map(lambda segment:
+            find_expired_jobs(segment, segments, cutoff), range(segments))
+        jobs = [job for segment_jobs in scans for job in segment_jobs]
+    if not jobs:
+        return
+
+    # Sweeps are infrequent, so roles are read fresh rather than cached
+    roles = helpers.get_roles((job["user_id"] for job in jobs),
+                              use_cache=False)
+    jobs = [job for job in jobs if roles.get(job["user_id"]) == "free_user"]
+
+    with ThreadPoolExecutor(
+            max_workers=int(config["aws"]["SweepWorkers"])) as executor:
+        archive_ids = list(executor.map(
+            lambda job: upload_result(job["s3_key_result_file"]), jobs))
+    archived = [(job, file_archive_id)
+                for job, file_archive_id in zip(jobs, archive_ids)
+                if file_archive_id]
+
+    # Results are only removed from S3 once their archive id is recorded
+    saved = save_archive_ids(archived)
+    delete_results([job["s3_key_result_file"] for job in saved])
+    print(f"Archived {len(saved)} of {len(jobs)} expired free user results")
+
+def handle_role_change(json_data):
+    """
+    Forget the cached role of a user who subscribed. Subscriptions publish a
+    user-level restore request, which also reaches the role changes queue
+    """
+    if json_data.get("restore_type") == "user":
+        helpers.invalidate_roles([json_data["user_id"]])
+    return True
+
+"""
+## ---------------------------- MAIN LOOP ------------------------------------##
+"""
+# Fetch item from config file
+region_name = config["aws"]['AwsRegionName']
+sqs_queue_name = config["aws"]['AwsSqsArchive']
+dynamo_table_name = config["aws"]["AwsDynamodbAnnotationsTable"]
+
+# Main Loop
+if config["aws"]["ArchiveMode"] == "sweep":
+    while True:
+        try:
+            sweep()
+        except (BotoCoreError, ClientError, psycopg2.Error) as e:
+            print(f"Archive sweep failed: {e}")
+        time.sleep(int(config["aws"]["SweepInterval"]))
+
+# Watch for subscriptions, so no cached free user role outlives an upgrade
+role_changes = sqs_consumer.SqsConsumer(
+    config["aws"]["AwsSqsRoleChanges"],
+    handle_role_change,
+    region_name=region_name,
+    workers=1,
+    wait_time=20,
+    name="archive role changes"
+)
+threading.Thread(target=role_changes.run, daemon=True).start()
 
-    # Delete the message using its handle
-    delete_msg(queue_url, message_handle)
+consumer = sqs_consumer.create_consumer(
+    config["aws"]["Runtime"],
+    sqs_queue_name,
+    handle_archive_message,
+    region_name=region_name,
+    workers=int(config["aws"]["ConsumerWorkers"]),
+    max_messages=int(config["aws"]["MaxMessagesPerReceive"]),
+    wait_time=int(config["aws"]["WaitTimeBetweenMessage"]),
+    visibility_timeout=int(config["aws"]["VisibilityTimeout"]),
+    heartbeat_interval=int(config["aws"]["HeartbeatInterval"]),
+    name="archive"
+)
+consumer.run()
 
 ### EOF
\ No newline at end of file
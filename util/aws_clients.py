@@ -0,0 +1,82 @@
+# aws_clients.py
+#
+# Process-wide registry of boto3 clients and resources
+#
+# Building a client costs tens of milliseconds and every new client opens
+# its own connections, so the GAS services share one client per service,
+# region and signature version for the life of the process. Clients are
+# thread-safe and shared by all threads; resources are not, so each thread
+# gets its own.
+##
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+# Get util configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
+
+default_region_name = config["aws"]["AwsRegionName"]
+max_pool_connections = int(config["aws"]["MaxPoolConnections"])
+
+lock = threading.Lock()
+local = threading.local()
+registry = {"pid": None, "session": None, "clients": {}}
+
+
+def get_session():
+    """
+    Get the process's boto3 session. Sessions and clients must not cross a
+    fork, so a child process starts with an empty registry. Call with the
+    registry lock held
+    """
+    if registry["pid"] != os.getpid():
+        registry["pid"] = os.getpid()
+        registry["session"] = boto3.session.Session()
+        registry["clients"] = {}
+        local.__dict__.clear()
+    return registry["session"]
+
+def client_config(signature_version=None):
+    return Config(max_pool_connections=max_pool_connections,
+                  signature_version=signature_version)
+
+def get_client(service, region_name=None, signature_version=None):
+    """
+    Get the shared client for a service, creating it on first use
+    """
+    key = (service, region_name or default_region_name, signature_version)
+    with lock:
+        session = get_session()
+        client = registry["clients"].get(key)
+        if client is None:
+            client = session.client(service, region_name=key[1],
+                                    config=client_config(signature_version))
+            registry["clients"][key] = client
+    return client
+
+def get_resource(service, region_name=None):
+    """
+    Get the calling thread's resource for a service, creating it on first use
+    """
+    key = (service, region_name or default_region_name)
+    with lock:
+        session = get_session()
+        resources = local.__dict__.setdefault("resources", {})
+        resource = resources.get(key)
+        if resource is None:
+            resource = session.resource(service, region_name=key[1],
+                                        config=client_config())
+            resources[key] = resource
+    return resource
+
+def get_table(table_name, region_name=None):
+    """
+    Get a DynamoDB table from the calling thread's resource
+    """
+    return get_resource("dynamodb", region_name).Table(table_name)
+
+### EOF
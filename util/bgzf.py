@@ -0,0 +1,106 @@
+# bgzf.py
+#
+# Blocked GNU Zip Format (BGZF) support
+#
+# BGZF files are a series of independent gzip members of at most 64 KB each,
+# so any gzip reader can decompress them while each block can also be
+# located and decompressed on its own. See the SAM/BAM specification, 4.1.
+#
+# Blocks written here end at a line boundary whenever a line fits in a
+# block, so the lines of a text file like a VCF can be read back block by
+# block (see result_index.py).
+##
+import struct
+import zlib
+
+# Uncompressed bytes per block; kept below 64 KB so that even incompressible
+# data fits in a block once deflated (same limit as htslib)
+BLOCK_DATA_SIZE = 0xff00
+
+# gzip member header with the BGZF 'BC' extra subfield holding BSIZE - 1
+BLOCK_HEADER = struct.Struct("<BBBBIBBHBBHH")
+BLOCK_TRAILER = struct.Struct("<II")
+
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def compress_block(data, level=6):
+    """
+    Deflate up to BLOCK_DATA_SIZE bytes into a single BGZF block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    block_size = BLOCK_HEADER.size + len(cdata) + BLOCK_TRAILER.size
+    header = BLOCK_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6,
+                               ord("B"), ord("C"), 2, block_size - 1)
+    trailer = BLOCK_TRAILER.pack(zlib.crc32(data) & 0xffffffff, len(data))
+    return header + cdata + trailer
+
+def iter_blocks(stream):
+    """
+    Decompress a stream of whole BGZF blocks (e.g. the body of a ranged
+    GET starting at a block offset), yielding the data and the compressed
+    bytes of each block
+    """
+    while True:
+        header = stream.read(BLOCK_HEADER.size)
+        if not header:
+            return
+        if len(header) < BLOCK_HEADER.size:
+            raise IOError("Truncated BGZF block header")
+        fields = BLOCK_HEADER.unpack(header)
+        if fields[:2] != (31, 139) or fields[8:10] != (ord("B"), ord("C")):
+            raise IOError("Not a BGZF block")
+        rest_size = fields[11] + 1 - BLOCK_HEADER.size
+        rest = stream.read(rest_size)
+        while len(rest) < rest_size:
+            chunk = stream.read(rest_size - len(rest))
+            if not chunk:
+                raise IOError("Truncated BGZF block")
+            rest += chunk
+        yield zlib.decompress(rest[:-BLOCK_TRAILER.size], -15), header + rest
+
+def read_blocks(stream):
+    """
+    Decompress a stream of whole BGZF blocks, yielding the data of each
+    """
+    for data, _ in iter_blocks(stream):
+        yield data
+
+
+"""Incremental BGZF compressor
+Mirrors the compress()/flush() interface of zlib compression objects, so it
+can be used wherever a gzip stream is produced incrementally. on_block, if
+given, is called with the data and the compressed bytes of every block
+"""
+class BgzfCompressor(object):
+    def __init__(self, level=6, on_block=None):
+        self.level = level
+        self.on_block = on_block
+        self.pending = b""
+
+    def block(self, data):
+        block = compress_block(data, self.level)
+        if self.on_block:
+            self.on_block(data, block)
+        return block
+
+    def compress(self, data):
+        self.pending += data
+        blocks = []
+        while len(self.pending) >= BLOCK_DATA_SIZE:
+            # End the block after its last complete line, if it has one
+            size = self.pending.rfind(b"\n", 0, BLOCK_DATA_SIZE) + 1 or \
+                BLOCK_DATA_SIZE
+            blocks.append(self.block(self.pending[:size]))
+            self.pending = self.pending[size:]
+        return b"".join(blocks)
+
+    def flush(self):
+        data = self.block(self.pending) if self.pending else b""
+        self.pending = b""
+        return data + EOF_BLOCK
+
+### EOF
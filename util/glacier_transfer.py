@@ -0,0 +1,212 @@
+# glacier_transfer.py
+#
+# Streaming transfers between S3 and Glacier
+#
+# Result files can be several GB, so they are never held in memory whole.
+# Archives are uploaded to Glacier part by part straight from the S3 body,
+# and restored archives are copied back to S3 range by range. Parts move in
+# parallel, but only GlacierTransferConcurrency of them are in memory at any
+# time. Glacier checks every part and the whole archive against SHA-256
+# tree hashes, which are computed incrementally from 1 MB leaf hashes.
+##
+import os
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Get util configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
+
+# Tree hash leaves are always 1 MB; part sizes must be a power of two
+# multiple of it
+MB = 1024 * 1024
+default_part_size = int(config["aws"]["GlacierPartSize"])
+default_concurrency = int(config["aws"]["GlacierTransferConcurrency"])
+
+
+def leaf_hashes(data):
+    """
+    SHA-256 digests of each 1 MB chunk of data
+    """
+    return [hashlib.sha256(data[i:i + MB]).digest()
+            for i in range(0, max(len(data), 1), MB)]
+
+def tree_hash(hashes):
+    """
+    Combine leaf hashes pairwise up to the root of the tree
+    """
+    hashes = list(hashes)
+    while len(hashes) > 1:
+        combined = [hashlib.sha256(hashes[i] + hashes[i + 1]).digest()
+                    for i in range(0, len(hashes) - 1, 2)]
+        if len(hashes) % 2:
+            combined.append(hashes[-1])
+        hashes = combined
+    return hashes[0].hex()
+
+def read_exactly(stream, size):
+    """
+    Read size bytes from a stream, fewer only at its end
+    """
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+def run_parts(part_tasks, max_workers):
+    """
+    Run (function, args) tasks on a thread pool, with at most max_workers
+    of them submitted at a time so that part data stays bounded. Tasks are
+    only taken from part_tasks when there is room. Results are returned in
+    task order; the first failure cancels the rest and is raised
+    """
+    results = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for function, args in part_tasks:
+                if len(pending) >= max_workers:
+                    results.append(pending.popleft().result())
+                pending.append(executor.submit(function, *args))
+            while pending:
+                results.append(pending.popleft().result())
+        except Exception:
+            for future in pending:
+                future.cancel()
+            raise
+    return results
+
+def abort_upload(abort, **kwargs):
+    """
+    Abort a failed multipart upload so its parts are not kept (and billed)
+    """
+    try:
+        abort(**kwargs)
+    except (BotoCoreError, ClientError) as e:
+        print(f"Unable to abort multipart upload: {e}")
+
+
+def upload_archive_stream(glacier, vault_name, stream, size,
+                          part_size=None, max_workers=None):
+    """
+    Upload size bytes read from stream (e.g. an S3 object's Body) to a
+    Glacier vault and return the archive id. Memory use is bounded by
+    max_workers + 1 parts whatever the size of the archive
+    """
+    part_size = part_size or default_part_size
+    max_workers = max_workers or default_concurrency
+
+    # Small archives go up in a single request
+    if size <= part_size:
+        data = read_exactly(stream, size)
+        response = glacier.upload_archive(vaultName=vault_name, body=data,
+                                          checksum=tree_hash(leaf_hashes(data)))
+        return response["archiveId"]
+
+    upload_id = glacier.initiate_multipart_upload(
+        vaultName=vault_name, partSize=str(part_size))["uploadId"]
+
+    def upload_part(start, data):
+        hashes = leaf_hashes(data)
+        glacier.upload_multipart_part(
+            vaultName=vault_name,
+            uploadId=upload_id,
+            range=f"bytes {start}-{start + len(data) - 1}/*",
+            checksum=tree_hash(hashes),
+            body=data
+        )
+        return hashes
+
+    def part_tasks():
+        start = 0
+        while start < size:
+            data = read_exactly(stream, min(part_size, size - start))
+            if not data:
+                raise IOError(f"Stream ended after {start} of {size} bytes")
+            yield upload_part, (start, data)
+            start += len(data)
+
+    try:
+        part_hashes = run_parts(part_tasks(), max_workers)
+        response = glacier.complete_multipart_upload(
+            vaultName=vault_name,
+            uploadId=upload_id,
+            archiveSize=str(size),
+            checksum=tree_hash(h for hashes in part_hashes for h in hashes)
+        )
+    except Exception as e:
+        abort_upload(glacier.abort_multipart_upload,
+                     vaultName=vault_name, uploadId=upload_id)
+        raise e
+    return response["archiveId"]
+
+
+def restore_archive_to_s3(glacier, vault_name, job_id, s3, bucket, key,
+                          part_size=None, max_workers=None):
+    """
+    Copy the output of a completed archive-retrieval job to an S3 object,
+    reading it in ranges and uploading them as multipart upload parts.
+    Every range and the whole archive are checked against Glacier's tree
+    hashes before the S3 object is completed
+    """
+    part_size = part_size or default_part_size
+    max_workers = max_workers or default_concurrency
+
+    job = glacier.describe_job(vaultName=vault_name, jobId=job_id)
+    size = job["ArchiveSizeInBytes"]
+    expected_hash = job["SHA256TreeHash"]
+
+    def read_range(start, end):
+        response = glacier.get_job_output(vaultName=vault_name, jobId=job_id,
+                                          range=f"bytes={start}-{end}")
+        data = response["body"].read()
+        hashes = leaf_hashes(data)
+        # Glacier only returns a checksum for tree hash aligned ranges
+        if "checksum" in response and response["checksum"] != tree_hash(hashes):
+            raise IOError(f"Tree hash mismatch in bytes {start}-{end} of job {job_id}")
+        return data, hashes
+
+    # Small archives come back in a single request
+    if size <= part_size:
+        data, hashes = read_range(0, max(size - 1, 0))
+        if tree_hash(hashes) != expected_hash:
+            raise IOError(f"Tree hash mismatch for job {job_id}")
+        s3.put_object(Bucket=bucket, Key=key, Body=data)
+        return
+
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def copy_part(part_number, start):
+        data, hashes = read_range(start, min(start + part_size, size) - 1)
+        response = s3.upload_part(Bucket=bucket, Key=key,
+                                  PartNumber=part_number, UploadId=upload_id,
+                                  Body=data)
+        return hashes, {"ETag": response["ETag"], "PartNumber": part_number}
+
+    part_tasks = ((copy_part, (n + 1, start))
+                  for n, start in enumerate(range(0, size, part_size)))
+    try:
+        parts = run_parts(part_tasks, max_workers)
+        if tree_hash(h for hashes, _ in parts for h in hashes) != expected_hash:
+            raise IOError(f"Tree hash mismatch for job {job_id}")
+        s3.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": [part for _, part in parts]}
+        )
+    except Exception as e:
+        abort_upload(s3.abort_multipart_upload,
+                     Bucket=bucket, Key=key, UploadId=upload_id)
+        raise e
+
+### EOF
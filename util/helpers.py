@@ -9,10 +9,11 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
-import json
-import boto3
 from botocore.exceptions import ClientError
 
+import aws_clients
+import secrets_cache
+
 # Get util configuration
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
@@ -23,7 +24,7 @@ config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_confi
 def send_email_ses(recipients=None, 
   sender=None, subject=None, body=None):
 
-  ses = boto3.client('ses', region_name=config['aws']['AwsRegionName'])
+  ses = aws_clients.get_client('ses', region_name=config['aws']['AwsRegionName'])
 
   try:
     response = ses.send_email(
@@ -41,40 +42,167 @@ def send_email_ses(recipients=None,
   return response
 
 
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 
-"""Access user profile in accounts database
+"""Accounts database connection pools, shared by all threads in the
+process. There is one pool per database, replaced by a fresh pool when
+rotated credentials change its URI; the old pool is closed once the
+connections borrowed from it are returned. Borrowers beyond the pool size
+wait for a free connection instead of failing with "connection pool
+exhausted"
 """
-def get_user_profile(id=None, db_name=None):
-  # Get database connection details from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
-  try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    raise ClientError
+accounts_db = {
+  'lock': threading.Lock(),
+  # database name -> (URI, pool)
+  'pools': {},
+  # pool -> number of its connections currently borrowed
+  'borrowed': {},
+  # pools replaced after a credential rotation, not closed yet
+  'retired': set(),
+  'slots': threading.BoundedSemaphore(
+    int(config['gas']['AccountsPoolMaxConnections']))
+}
 
+"""Get the connection pool for the accounts database, counting a
+connection as borrowed from it
+"""
+def borrow_accounts_pool(db_name=None):
+  # Get database connection details from AWS Secrets Manager (cached)
+  db_name = db_name or config['gas']['AccountsDatabase']
+  rds_secret = secrets_cache.get_secret('rds/accounts_database',
+    region_name=config['aws']['AwsRegionName'])
   db_uri = "postgresql://" + rds_secret['username'] + ':' + \
     rds_secret['password'] + '@' + rds_secret['host'] + ':' + \
-    str(rds_secret['port']) + '/' + \
-    (db_name or config['gas']['AccountsDatabase'])
+    str(rds_secret['port']) + '/' + db_name
 
-  try:
-    # Connect to accounts database and get a cursor
-    connection = psycopg2.connect(db_uri)
+  with accounts_db['lock']:
+    uri, pool = accounts_db['pools'].get(db_name, (None, None))
+    if uri != db_uri:
+      if pool is not None:
+        accounts_db['retired'].add(pool)
+        close_retired_pool(pool)
+      pool = psycopg2.pool.ThreadedConnectionPool(
+        int(config['gas']['AccountsPoolMinConnections']),
+        int(config['gas']['AccountsPoolMaxConnections']),
+        db_uri)
+      accounts_db['pools'][db_name] = (db_uri, pool)
+    accounts_db['borrowed'][pool] = accounts_db['borrowed'].get(pool, 0) + 1
+  return pool
+
+"""Count a connection as returned to its pool
+"""
+def release_accounts_pool(pool):
+  with accounts_db['lock']:
+    accounts_db['borrowed'][pool] -= 1
+    close_retired_pool(pool)
+
+"""Close a retired pool once none of its connections are borrowed; call
+with the lock held
+"""
+def close_retired_pool(pool):
+  if pool in accounts_db['retired'] and not accounts_db['borrowed'].get(pool):
+    accounts_db['retired'].discard(pool)
+    accounts_db['borrowed'].pop(pool, None)
+    pool.closeall()
+
+"""Borrow a pooled connection to the accounts database
+The connection's transaction is ended and the connection returned to the
+pool on exit; connections broken by an error are discarded
+"""
+@contextmanager
+def accounts_connection(db_name=None):
+  with accounts_db['slots']:
+    pool = borrow_accounts_pool(db_name)
+    try:
+      connection = pool.getconn()
+      try:
+        yield connection
+        connection.commit()
+      except psycopg2.Error as e:
+        if not connection.closed:
+          connection.rollback()
+        raise e
+      finally:
+        pool.putconn(connection, close=bool(connection.closed))
+    finally:
+      release_accounts_pool(pool)
+
+"""Access user profile in accounts database
+"""
+def get_user_profile(id=None, db_name=None):
+  with accounts_connection(db_name) as connection:
     cursor = connection.cursor(cursor_factory = psycopg2.extras.DictCursor)
-    
+
     # Query the database and get the user's profile record
-    query_string = f"SELECT * FROM profiles WHERE identity_id = '{id}'"
-    cursor.execute(query_string)
+    cursor.execute("SELECT * FROM profiles WHERE identity_id = %s", (id,))
     profile = cursor.fetchall()[0]
-  
-  except psycopg2.Error as e:
-    connection.rollback()
-    raise psycopg2.Error
+    cursor.close()
 
   # Return user profile record as a dict
   return profile
 
+"""User role cache, shared by all threads in the process
+Entries expire after RoleCacheTTL seconds, or RoleCacheFreeUserTTL for
+free users, who can upgrade at any time; beyond RoleCacheSize entries the
+least recently used are evicted
+"""
+role_cache = {
+  'lock': threading.Lock(),
+  'roles': OrderedDict()
+}
+
+"""Get the roles of several users
+Cached roles are used where possible and the rest are read with a single
+query. Returns a dict mapping identity_id to role; unknown users are left
+out
+"""
+def get_roles(user_ids, db_name=None, use_cache=True):
+  user_ids = set(user_ids)
+  roles = {}
+  now = time.time()
+  if use_cache:
+    with role_cache['lock']:
+      for user_id in user_ids:
+        entry = role_cache['roles'].get(user_id)
+        if entry and entry[0] > now:
+          role_cache['roles'].move_to_end(user_id)
+          roles[user_id] = entry[1]
+
+  missing = list(user_ids - set(roles))
+  if not missing:
+    return roles
+  with accounts_connection(db_name) as connection:
+    cursor = connection.cursor()
+    cursor.execute(
+      "SELECT identity_id, role FROM profiles WHERE identity_id = ANY(%s::uuid[])",
+      (missing,))
+    fetched = dict(cursor.fetchall())
+    cursor.close()
+
+  ttl = int(config['gas']['RoleCacheTTL'])
+  free_user_ttl = int(config['gas']['RoleCacheFreeUserTTL'])
+  with role_cache['lock']:
+    for user_id, role in fetched.items():
+      expires = now + (free_user_ttl if role == "free_user" else ttl)
+      role_cache['roles'][user_id] = (expires, role)
+      role_cache['roles'].move_to_end(user_id)
+    while len(role_cache['roles']) > int(config['gas']['RoleCacheSize']):
+      role_cache['roles'].popitem(last=False)
+  roles.update(fetched)
+  return roles
+
+"""Drop cached roles, e.g. when users subscribe
+"""
+def invalidate_roles(user_ids):
+  with role_cache['lock']:
+    for user_id in user_ids:
+      role_cache['roles'].pop(user_id, None)
+
 ### EOF
\ No newline at end of file
@@ -10,12 +10,16 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import os
 import sys
 import json
-import boto3
+from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import aws_clients
+import sqs_consumer
+import restore_jobs
+import tiers
 
 # Get configuration
 from configparser import ConfigParser
@@ -27,134 +31,203 @@ config.read('restore_config.ini')
 """
 ## ------------------------- HELPER FUNCTIONS -------------------------------##
 """
-def receive_message(url):
-    try:
-        response = sqs_client.receive_message(
-            QueueUrl=url,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=int(config["aws"]["WaitTimeBetweenMessage"])
-        )
-    except ClientError as e:
-        print(e)
-        return None
-    messages = response.get("Messages", [])
-    print(f"Number of messages received: {len(messages)}")
-    if len(messages) > 0:
-        return messages[0]
-    return None
-
-def parse_response(response):
-    print(response)
-    try:
-        json_response = json.loads(response)
-        json_body = json.loads(json_response["Message"])
-        return json_body
-    except Exception as e:
-        print("Parse Error")
-        print(e)
-        return None
-
-def delete_msg(url, handle):
+def find_archived_jobs(user_id):
+    """
+    Get every job of a user whose result file is archived in Glacier and
+    not already being restored (e.g. by an earlier delivery of the same
+    request)
+    """
+    table = aws_clients.get_table(dynamo_table_name, region_name)
+    query = {
+        "IndexName": "user_id_index",
+        "KeyConditionExpression": Key("user_id").eq(user_id),
+        "FilterExpression": Attr("results_file_archive_id").exists() &
+            Attr("restore_message").not_exists(),
+        "ProjectionExpression": "job_id, user_id, results_file_archive_id"
+    }
+    jobs = []
+    while True:
+        response = table.query(**query)
+        jobs.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            return jobs
+        query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+def publish_job_restores(jobs):
+    """
+    Publish one restore message per job, 10 per request. Entries that fail
+    are retried once; returns the ids of the jobs that were published
+    """
+    sns = aws_clients.get_client("sns", region_name)
+    batch_size = len(jobs)
+    published = []
+    for attempt in range(2):
+        failed = []
+        for i in range(0, len(jobs), 10):
+            batch = jobs[i:i + 10]
+            entries = [{
+                "Id": str(n),
+                "MessageStructure": "json",
+                "Message": json.dumps({'default': json.dumps({
+                    "results_file_archive_id": job["results_file_archive_id"],
+                    "user_id": job["user_id"],
+                    "job_id": job["job_id"],
+                    "priority": tiers.BATCH,
+                    "batch_size": batch_size
+                })})
+            } for n, job in enumerate(batch)]
+            try:
+                response = sns.publish_batch(
+                    TopicArn=config["aws"]["AwsSnsRestoreTopic"],
+                    PublishBatchRequestEntries=entries
+                )
+            except ClientError as e:
+                print(f"Unable to publish restore requests: {e}")
+                failed.extend(batch)
+                continue
+            published.extend(batch[int(entry["Id"])]["job_id"]
+                             for entry in response.get("Successful", []))
+            failed.extend(batch[int(entry["Id"])]
+                          for entry in response.get("Failed", []))
+        jobs = failed
+        if not jobs:
+            break
+    for job in jobs:
+        print(f"Unable to request restore of job {job['job_id']}")
+    return published
+
+def set_restore_messages(job_ids):
+    """
+    Flag jobs as being restored, in transactions of up to 25 updates;
+    returns True if every job was flagged
+    """
+    dynamo = aws_clients.get_client("dynamodb", region_name)
+    flagged = True
+    for i in range(0, len(job_ids), 25):
+        try:
+            dynamo.transact_write_items(TransactItems=[{
+                "Update": {
+                    "TableName": dynamo_table_name,
+                    "Key": {"job_id": {"S": job_id}},
+                    "UpdateExpression": "set restore_message = :m",
+                    "ExpressionAttributeValues": {":m": {"S": RESTORE_MESSAGE}}
+                }
+            } for job_id in job_ids[i:i + 25]])
+        except ClientError as e:
+            print(f"Unable to update restore messages: {e}")
+            flagged = False
+    return flagged
+
+def restore_user_archives(user_id):
+    """
+    Fan a user-level restore request (sent when a user subscribes) out into
+    one restore message per archived result file
+    """
     try:
-        response = sqs_client.delete_message(
-            QueueUrl=url,
-            ReceiptHandle=handle,
-        )
-        messageID = response["ResponseMetadata"]["RequestId"]
-        print("message deleted")
+        jobs = find_archived_jobs(user_id)
     except ClientError as e:
-        print(e)
-
-"""
-## ---------------------------- MAIN LOOP ------------------------------------##
-"""
-# Fetch item from config file
-region_name = config["aws"]['AwsRegionName']
-sqs_queue_name = config["aws"]['AwsSqsRestore']
-dynamo_table_name = config["aws"]["AwsDynamodbAnnotationsTable"]
-
-try:
-    sqs_client = boto3.client("sqs", region_name = region_name)
-    queue_url = sqs_client.get_queue_url(QueueName=sqs_queue_name)["QueueUrl"]
-except ClientError as e:
-    print("Error Here")
-    print(e)
-    raise e
-
-# Main Loop
-# Add utility code here
-
-while True:
-    # Long poll for message on provided SQS queue, if no response, continue
-    response = receive_message(queue_url)
-    if response == None:
-        continue
-    
-    message_handle = response["ReceiptHandle"]
-    message_body = response["Body"]
-
-    # If json_data is not successfully parsed, continue
-    json_data = parse_response(message_body)
-    if json_data == None:
-        continue
-    
-    # Remove file from S3 and add to Glacier
+        print(f"An Error was encountered when querying dynamoDB: {e}")
+        return False
+    print(f"Restoring {len(jobs)} archived results for user {user_id}")
+    published = publish_job_restores(jobs)
+    flagged = set_restore_messages(published)
+    # Keep the message for redelivery until every job was published; jobs
+    # flagged as being restored are skipped then
+    return flagged and len(published) == len(jobs)
+
+def restore_job_archive(json_data):
+    """
+    Start the Glacier retrieval of one job's result file. Glacier notifies
+    the thaw utility through its topic once the file is ready
+    """
     user_id = json_data["user_id"]
     results_file_archive_id = json_data["results_file_archive_id"]
     job_id = json_data["job_id"]
 
-    # Initiate Job to restore archived data
-    client = boto3.client('glacier', region_name = config["aws"]["AwsRegionName"])
+    # Initiate Job to restore archived data, in the tier the scheduler
+    # picks for the request
+    client = aws_clients.get_client('glacier', region_name)
     glacier_vault = config["aws"]["AwsGlacierVault"]
-    expedited_success = False
+    job_parameters = {
+        "Type": "archive-retrieval",
+        "ArchiveId": results_file_archive_id,
+        "SNSTopic": config["aws"]["AwsSnsThawTopic"]
+    }
+    tier = scheduler.choose(json_data.get("priority", tiers.BATCH),
+                            int(json_data.get("batch_size", 1)))
     try:
         response = client.initiate_job(
             vaultName = glacier_vault,
-            jobParameters = {
-                "Type": "archive-retrieval",
-                "ArchiveId": results_file_archive_id,
-                "Tier": "Expedited",
-            }
+            jobParameters = dict(job_parameters, Tier=tier)
         )
-        expedited_success = True
         print(response)
     except ClientError as e:
         print(e)
-        pass
-
-    if not expedited_success:
+        if tier != tiers.EXPEDITED:
+            return False
+        # Fall back to Standard when Expedited is unavailable
+        scheduler.expedited_failed(
+            e.response["Error"]["Code"] == "InsufficientCapacityException")
+        tier = tiers.STANDARD
         try:
             response = client.initiate_job(
                 vaultName = glacier_vault,
-                jobParameters = {
-                    "Type": "archive-retrieval",
-                    "ArchiveId": results_file_archive_id
-                }
+                jobParameters = dict(job_parameters, Tier=tier)
             )
             print(response)
         except ClientError as e:
             print(e)
-            continue
+            return False
 
+    # Track the retrieval until thaw has put the file back in S3
     try:
-        data = {
-          "restore_request_id": response["ResponseMetadata"]["RequestId"],
-          "restore_job_id": response["jobId"],
-          #"s3_key_result_file" = json_data["s3_key_result_file"]
-          "results_file_archive_id": results_file_archive_id,
-          "user_id": user_id,
-          "job_id": job_id
-        }
-        sns = boto3.client("sns", region_name = region_name)
-        sns.publish(
-          TopicArn=config["aws"]["AwsSnsThawTopic"],
-          MessageStructure="json",
-          Message=json.dumps({'default': json.dumps(data)})
-        )
+        restore_jobs.track_job(response["jobId"], job_id, user_id,
+                               results_file_archive_id, tier, region_name)
     except ClientError as e:
-        print(f"An Error was encountered when publishing to result thaw SNS: {e}")
+        print(f"Unable to track restore job {response['jobId']}: {e}")
+        return False
+
+    return True
+
+def handle_restore_message(json_data):
+    """
+    Handle a restore request; returns True once the message can be deleted
+    """
+    # A user-level request is split into per-job requests
+    if json_data.get("restore_type") == "user":
+        return restore_user_archives(json_data["user_id"])
+    return restore_job_archive(json_data)
+
+"""
+## ---------------------------- MAIN LOOP ------------------------------------##
+"""
+# Fetch item from config file
+region_name = config["aws"]['AwsRegionName']
+sqs_queue_name = config["aws"]['AwsSqsRestore']
+dynamo_table_name = config["aws"]["AwsDynamodbAnnotationsTable"]
+
+RESTORE_MESSAGE = "Your Annotation Result File is Currently being restored"
 
-    # Delete the message using its handle
-    delete_msg(queue_url, message_handle)
+scheduler = tiers.TierScheduler(
+    int(config["aws"]["MaxExpeditedJobs"]),
+    int(config["aws"]["ExpeditedJobSeconds"]),
+    int(config["aws"]["ExpeditedCooldown"]),
+    int(config["aws"]["BulkBatchThreshold"])
+)
+
+# Main Loop
+consumer = sqs_consumer.create_consumer(
+    config["aws"]["Runtime"],
+    sqs_queue_name,
+    handle_restore_message,
+    region_name=region_name,
+    workers=int(config["aws"]["ConsumerWorkers"]),
+    max_messages=int(config["aws"]["MaxMessagesPerReceive"]),
+    wait_time=int(config["aws"]["WaitTimeBetweenMessage"]),
+    visibility_timeout=int(config["aws"]["VisibilityTimeout"]),
+    heartbeat_interval=int(config["aws"]["HeartbeatInterval"]),
+    name="restore"
+)
+consumer.run()
 
 ### EOF
\ No newline at end of file
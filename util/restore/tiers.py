@@ -0,0 +1,66 @@
+# tiers.py
+#
+# Glacier retrieval tier scheduling for the restore utility
+#
+# Expedited retrievals come back in minutes but capacity for them is
+# limited, so they are kept for interactive restores (the file a premium
+# user is looking at). Restores of a user's whole archive after subscribing
+# use Standard, or Bulk when the batch is large. At most MaxExpeditedJobs
+# Expedited retrievals are counted as running at once. After Glacier
+# reports insufficient Expedited capacity, interactive restores use
+# Standard until ExpeditedCooldown seconds have passed.
+##
+import time
+import threading
+
+EXPEDITED = "Expedited"
+STANDARD = "Standard"
+BULK = "Bulk"
+
+# Restore request priorities
+INTERACTIVE = "interactive"
+BATCH = "bulk"
+
+
+"""Chooses the retrieval tier for each restore request
+"""
+class TierScheduler(object):
+    def __init__(self, max_expedited, expedited_seconds, cooldown,
+                 bulk_threshold):
+        self.max_expedited = max_expedited
+        self.expedited_seconds = expedited_seconds
+        self.cooldown = cooldown
+        self.bulk_threshold = bulk_threshold
+        self.lock = threading.Lock()
+        # Start times of Expedited jobs assumed to be still running
+        self.expedited = []
+        self.cooldown_until = 0
+
+    def choose(self, priority, batch_size=1):
+        """
+        Pick a tier; an Expedited pick holds one of the Expedited slots
+        """
+        if priority != INTERACTIVE:
+            return BULK if batch_size >= self.bulk_threshold else STANDARD
+
+        now = time.time()
+        with self.lock:
+            self.expedited = [started for started in self.expedited
+                              if now - started < self.expedited_seconds]
+            if now < self.cooldown_until or \
+                    len(self.expedited) >= self.max_expedited:
+                return STANDARD
+            self.expedited.append(now)
+            return EXPEDITED
+
+    def expedited_failed(self, out_of_capacity):
+        """
+        Give back the slot of an Expedited job that could not be started
+        """
+        with self.lock:
+            if self.expedited:
+                self.expedited.pop()
+            if out_of_capacity:
+                self.cooldown_until = time.time() + self.cooldown
+
+### EOF
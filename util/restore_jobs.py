@@ -0,0 +1,148 @@
+# restore_jobs.py
+#
+# Tracker of outstanding Glacier retrieval jobs
+#
+# The restore utility records every archive-retrieval job it starts, and
+# Glacier notifies the thaw topic when the job has completed. Thaw only
+# ever touches jobs that Glacier reports as done. Entries are removed once
+# the results are back in S3. Any tracked job whose notification went
+# missing is found by polling list_jobs and dispatched to thaw in its
+# place.
+##
+import os
+import time
+import json
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+import aws_clients
+
+# Get util configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
+
+tracker_table_name = config["aws"]["AwsDynamodbRestoreJobsTable"]
+
+# Tracked job states
+IN_PROGRESS = "IN_PROGRESS"
+DISPATCHED = "DISPATCHED"
+FAILED = "FAILED"
+
+
+def get_tracker(region_name=None):
+    return aws_clients.get_table(tracker_table_name, region_name)
+
+def track_job(restore_job_id, job_id, user_id, results_file_archive_id,
+              tier=None, region_name=None):
+    """
+    Record a newly started retrieval job
+    """
+    item = {
+        "restore_job_id": restore_job_id,
+        "job_id": job_id,
+        "user_id": user_id,
+        "results_file_archive_id": results_file_archive_id,
+        "job_status": IN_PROGRESS,
+        "requested_at": int(time.time())
+    }
+    if tier:
+        item["tier"] = tier
+    get_tracker(region_name).put_item(Item=item)
+
+def get_job(restore_job_id, region_name=None):
+    """
+    Get a tracked job, or None once it has been thawed
+    """
+    response = get_tracker(region_name).get_item(
+        Key={"restore_job_id": restore_job_id})
+    return response.get("Item")
+
+def finish_job(restore_job_id, region_name=None):
+    get_tracker(region_name).delete_item(Key={"restore_job_id": restore_job_id})
+
+def fail_job(restore_job_id, reason, region_name=None):
+    get_tracker(region_name).update_item(
+        Key={"restore_job_id": restore_job_id},
+        UpdateExpression="set job_status = :s, failure = :f",
+        ExpressionAttributeValues={":s": FAILED, ":f": reason}
+    )
+
+def outstanding_jobs(region_name=None):
+    """
+    Ids of tracked jobs that have not been dispatched to thaw
+    """
+    table = get_tracker(region_name)
+    scan = {
+        "FilterExpression": Attr("job_status").eq(IN_PROGRESS),
+        "ProjectionExpression": "restore_job_id"
+    }
+    while True:
+        response = table.scan(**scan)
+        for item in response["Items"]:
+            yield item["restore_job_id"]
+        if "LastEvaluatedKey" not in response:
+            return
+        scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+def completed_jobs(vault_name, settled_for, region_name=None):
+    """
+    Completed retrieval jobs in a vault that finished at least settled_for
+    seconds ago, i.e. whose completion notification should long since have
+    been handled. Maps job id to the job description
+    """
+    glacier = aws_clients.get_client("glacier", region_name)
+    cutoff = time.strftime("%Y-%m-%dT%H:%M:%S",
+                           time.gmtime(time.time() - settled_for))
+    jobs = {}
+    for page in glacier.get_paginator("list_jobs").paginate(
+            vaultName=vault_name, completed="true"):
+        for job in page["JobList"]:
+            if job["Action"] == "ArchiveRetrieval" and \
+                    job["CompletionDate"][:19] <= cutoff:
+                jobs[job["JobId"]] = job
+    return jobs
+
+def dispatch_ready_jobs(vault_name, topic_arn, settled_for, region_name=None):
+    """
+    Publish the completion of tracked jobs whose Glacier notification never
+    arrived, exactly as Glacier would have. Returns the number dispatched
+    """
+    outstanding = list(outstanding_jobs(region_name))
+    if not outstanding:
+        return 0
+    completed = completed_jobs(vault_name, settled_for, region_name)
+
+    sns = aws_clients.get_client("sns", region_name)
+    table = get_tracker(region_name)
+    dispatched = 0
+    for restore_job_id in outstanding:
+        job = completed.get(restore_job_id)
+        if job is None:
+            continue
+        # Only one poller may dispatch a job
+        try:
+            table.update_item(
+                Key={"restore_job_id": restore_job_id},
+                UpdateExpression="set job_status = :d",
+                ConditionExpression=Attr("job_status").eq(IN_PROGRESS),
+                ExpressionAttributeValues={":d": DISPATCHED}
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                print(f"Unable to dispatch restore job {restore_job_id}: {e}")
+            continue
+        try:
+            sns.publish(TopicArn=topic_arn, Message=json.dumps(job))
+            dispatched += 1
+        except ClientError as e:
+            print(f"Unable to dispatch restore job {restore_job_id}: {e}")
+            table.update_item(
+                Key={"restore_job_id": restore_job_id},
+                UpdateExpression="set job_status = :p",
+                ExpressionAttributeValues={":p": IN_PROGRESS}
+            )
+    return dispatched
+
+### EOF
@@ -0,0 +1,209 @@
+# result_index.py
+#
+# Block index of BGZF compressed annotated VCF files
+#
+# For every BGZF block of a result file the index holds its offset and
+# size in the compressed file and the chromosome positions of the records
+# in it, so the records of a region can be fetched with ranged reads
+# instead of a full download. Records are counted in the block where their
+# line ends; a block that starts part way through a line is marked as
+# continued. As in other VCF indexes (tabix), records must be sorted by
+# position within each chromosome, so only the first and last record of
+# each chromosome in a block are parsed and indexing does not slow down
+# the upload. The index is saved as JSON next to the result file, under the
+# same key with INDEX_SUFFIX appended. read_region uses it to stream the
+# records of a region with S3 ranged GETs. Archiving deletes the index with
+# the result file; rebuild_index recreates it once the file is restored.
+##
+import re
+import json
+
+import bgzf
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+
+# Enough of a line to read its CHROM and POS columns
+LINE_PREFIX_SIZE = 1024
+
+# CHROM and POS at the start of a record line (not a '#' header line)
+RECORD_START = re.compile(rb"^([^\t\n#][^\t\n]*)\t(\d+)(?=[\t\r\n])", re.M)
+
+
+"""Builds the index of a file while BgzfCompressor writes it
+Pass add_block as the compressor's on_block callback
+"""
+class ResultIndexer(object):
+    def __init__(self):
+        self.offset = 0
+        self.blocks = []
+        self.continued = False
+        self.carry = b""
+
+    def add_block(self, data, block):
+        ranges = []
+        # The line ending first in this block may have started in the last
+        first = data.find(b"\n") + 1
+        if first:
+            record = RECORD_START.match(self.carry + data[:first])
+            if record:
+                add_range(ranges, record.group(1), record.group(2), record.group(2))
+            last = data.rfind(b"\n") + 1
+            add_ranges(ranges, data, first, last)
+            tail = data[last:]
+        else:
+            tail = self.carry + data
+
+        self.blocks.append([self.offset, len(block), self.continued, ranges])
+        self.offset += len(block)
+        self.continued = bool(tail)
+        self.carry = tail[:LINE_PREFIX_SIZE]
+
+    def to_json(self):
+        return json.dumps({"version": INDEX_VERSION, "blocks": self.blocks})
+
+
+def rebuild_index(s3_client, bucket_name, key):
+    """
+    Index a result file already in S3 (e.g. restored from Glacier) and
+    save the index next to it. Returns False for files that are not BGZF
+    compressed, which cannot be indexed
+    """
+    response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    indexer = ResultIndexer()
+    try:
+        for data, block in bgzf.iter_blocks(response["Body"]):
+            # The empty end of file block is not indexed
+            if data:
+                indexer.add_block(data, block)
+    except IOError as e:
+        if not indexer.blocks:
+            return False
+        raise e
+    finally:
+        response["Body"].close()
+    s3_client.put_object(Bucket=bucket_name, Key=key + INDEX_SUFFIX,
+                         Body=indexer.to_json().encode(),
+                         ContentType="application/json")
+    return True
+
+def add_range(ranges, chrom, first, last):
+    """
+    Extend the [chrom, start, end] position ranges of a block with the
+    positions first and last (byte strings) of chrom
+    """
+    try:
+        chrom = chrom.decode()
+    except UnicodeDecodeError:
+        return
+    start, end = sorted((int(first), int(last)))
+    if ranges and ranges[-1][0] == chrom:
+        ranges[-1][1] = min(ranges[-1][1], start)
+        ranges[-1][2] = max(ranges[-1][2], end)
+    else:
+        ranges.append([chrom, start, end])
+
+def add_ranges(ranges, data, start, end):
+    """
+    Add the position ranges of the complete lines in data[start:end].
+    Records are sorted by position within each chromosome, so only the
+    first and last record of each chromosome's run of lines are parsed;
+    the last is found with one rfind
+    """
+    offset = start
+    while offset < end:
+        record = RECORD_START.match(data, offset, end)
+        if not record:
+            # Header line
+            offset = data.find(b"\n", offset, end) + 1 or end
+            continue
+        chrom, first = record.groups()
+        run_end = data.rfind(b"\n" + chrom + b"\t", offset, end - 1)
+        last_line = run_end + 1 if run_end >= offset else offset
+        last = RECORD_START.match(data, last_line, end)
+        add_range(ranges, chrom, first, last.group(2) if last else first)
+        offset = data.find(b"\n", last_line, end) + 1 or end
+
+def overlaps(ranges, chrom, start, end):
+    return any(r_chrom == chrom and r_start <= end and r_end >= start
+               for r_chrom, r_start, r_end in ranges)
+
+def region_spans(index, chrom, start, end, gap=bgzf.BLOCK_DATA_SIZE):
+    """
+    Byte ranges (first, last) of the compressed file holding every record
+    of chrom between start and end. Each range starts at a line boundary;
+    ranges less than gap bytes apart are merged to save requests
+    """
+    blocks = index["blocks"]
+    spans = []
+    for i, (offset, size, continued, ranges) in enumerate(blocks):
+        if not overlaps(ranges, chrom, start, end):
+            continue
+        # Go back to the block where the first line ending here starts
+        first = i
+        while blocks[first][2]:
+            first -= 1
+        span = [blocks[first][0], offset + size - 1]
+        if spans and span[0] <= spans[-1][1] + 1 + gap:
+            spans[-1][1] = max(spans[-1][1], span[1])
+        else:
+            spans.append(span)
+    return [tuple(span) for span in spans]
+
+def header_span(index):
+    """
+    Byte range of the blocks before the first record, i.e. the VCF header;
+    None for an empty file
+    """
+    blocks = index["blocks"]
+    if not blocks:
+        return None
+    last = 0
+    while last < len(blocks) - 1 and not blocks[last][3]:
+        last += 1
+    return (0, blocks[last][0] + blocks[last][1] - 1)
+
+def read_lines(s3_client, bucket_name, key, span):
+    """
+    Complete lines in a byte range of a result file, read with a ranged GET
+    """
+    response = s3_client.get_object(Bucket=bucket_name, Key=key,
+                                    Range=f"bytes={span[0]}-{span[1]}")
+    carry = b""
+    try:
+        for data in bgzf.read_blocks(response["Body"]):
+            lines = (carry + data).split(b"\n")
+            carry = lines.pop()
+            for line in lines:
+                yield line
+    finally:
+        response["Body"].close()
+
+def read_region(s3_client, bucket_name, key, index, chrom, start, end):
+    """
+    Yield the VCF header and then the records of chrom between start and
+    end (inclusive), as lines ending in a newline, reading only the blocks
+    that hold them
+    """
+    span = header_span(index)
+    if span is None:
+        return
+    for line in read_lines(s3_client, bucket_name, key, span):
+        if line.startswith(b"#"):
+            yield line + b"\n"
+
+    target = chrom.encode()
+    for span in region_spans(index, chrom, start, end):
+        for line in read_lines(s3_client, bucket_name, key, span):
+            fields = line.split(b"\t", 2)
+            if fields[0] != target or len(fields) < 2 or \
+                    line.startswith(b"#"):
+                continue
+            try:
+                pos = int(fields[1])
+            except ValueError:
+                continue
+            if start <= pos <= end:
+                yield line + b"\n"
+
+### EOF
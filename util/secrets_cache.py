@@ -0,0 +1,128 @@
+# secrets_cache.py
+#
+# Cached access to AWS Secrets Manager, shared by the web app and utilities
+#
+# Secrets are kept for SecretsTTL seconds. Within SecretsRefreshAhead
+# seconds of expiry a lookup returns the cached value and refreshes it in
+# the background, so callers rarely wait on Secrets Manager. If a refresh
+# fails, the last known value keeps being served.
+#
+# For offline runs a secret can be supplied locally, either as JSON in an
+# environment variable named GAS_SECRET_<SECRET_ID> (upper case, with
+# non-alphanumeric characters replaced by '_'), or in a JSON file mapping
+# secret ids to values, named by the GAS_SECRETS_FILE environment variable.
+##
+import os
+import re
+import json
+import time
+import threading
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+import aws_clients
+
+# Get util configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
+
+secrets_ttl = int(config["aws"]["SecretsTTL"])
+refresh_ahead = int(config["aws"]["SecretsRefreshAhead"])
+
+lock = threading.Lock()
+# secret id -> {"value": dict, "time": fetch time, "refreshing": bool}
+cache = {}
+
+
+def local_secret(secret_id):
+    """
+    Look up a locally supplied stand-in for a secret, if there is one
+    """
+    env_name = "GAS_SECRET_" + re.sub(r"[^A-Za-z0-9]", "_", secret_id).upper()
+    if env_name in os.environ:
+        return json.loads(os.environ[env_name])
+
+    secrets_file = os.environ.get("GAS_SECRETS_FILE")
+    if secrets_file and os.path.exists(secrets_file):
+        with open(secrets_file) as f:
+            secrets = json.load(f)
+        if secret_id in secrets:
+            return secrets[secret_id]
+    return None
+
+def store(secret_id, value):
+    with lock:
+        cache[secret_id] = {"value": value, "time": time.time(),
+                            "refreshing": False}
+    return value
+
+def fetch_secret(secret_id, region_name=None):
+    """
+    Fetch a secret from Secrets Manager and cache it
+    """
+    asm = aws_clients.get_client("secretsmanager", region_name)
+    response = asm.get_secret_value(SecretId=secret_id)
+    return store(secret_id, json.loads(response["SecretString"]))
+
+def refresh_secret(secret_id, region_name=None):
+    """
+    Refresh a cached secret, keeping the old value if Secrets Manager fails
+    """
+    try:
+        return fetch_secret(secret_id, region_name)
+    except (BotoCoreError, ClientError) as e:
+        print(f"Unable to refresh secret {secret_id}, using cached value: {e}")
+        with lock:
+            cache[secret_id]["refreshing"] = False
+            return cache[secret_id]["value"]
+
+def get_secret(secret_id, region_name=None):
+    """
+    Get a secret as a dict. Errors are only raised when no value for the
+    secret has been fetched yet
+    """
+    value = local_secret(secret_id)
+    if value is not None:
+        return value
+
+    with lock:
+        entry = cache.get(secret_id)
+        if entry is not None:
+            age = time.time() - entry["time"]
+            if age < secrets_ttl - refresh_ahead or \
+                    (age < secrets_ttl and entry["refreshing"]):
+                return entry["value"]
+            if age < secrets_ttl:
+                # About to expire: serve the cached value, refresh behind it
+                entry["refreshing"] = True
+                threading.Thread(target=refresh_secret,
+                                 args=(secret_id, region_name),
+                                 daemon=True).start()
+                return entry["value"]
+
+    if entry is None:
+        return fetch_secret(secret_id, region_name)
+    return refresh_secret(secret_id, region_name)
+
+def prefetch_secrets(secret_ids, region_name=None):
+    """
+    Load several secrets with a single Secrets Manager request where the
+    API supports it, e.g. while a web worker boots
+    """
+    secret_ids = [secret_id for secret_id in secret_ids
+                  if local_secret(secret_id) is None]
+    if not secret_ids:
+        return
+    asm = aws_clients.get_client("secretsmanager", region_name)
+    if not hasattr(asm, "batch_get_secret_value"):
+        return
+    try:
+        response = asm.batch_get_secret_value(SecretIdList=secret_ids)
+    except (BotoCoreError, ClientError) as e:
+        print(f"Unable to prefetch secrets: {e}")
+        return
+    for secret in response["SecretValues"]:
+        store(secret["Name"], json.loads(secret["SecretString"]))
+
+### EOF
@@ -0,0 +1,237 @@
+# sqs_consumer.py
+#
+# Shared SQS consumer for the annotator and the archive, restore and thaw
+# utilities
+#
+# Messages are received in batches of up to 10 and handed to a pool of
+# worker threads, never more than there are free workers (backpressure).
+# A handler gets the message parsed out of its SNS envelope and returns
+# True once the message can be deleted; deletes are batched. Messages being
+# handled can have their visibility extended while they run, and SIGTERM or
+# SIGINT stops receiving and lets in-flight messages finish. See
+# aio_consumer.py for the asyncio runtime.
+##
+import json
+import time
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+
+
+def parse_message(body):
+    """
+    Get the JSON payload of an SNS notification delivered through SQS
+    """
+    try:
+        json_response = json.loads(body)
+        return json.loads(json_response["Message"])
+    except Exception as e:
+        print(f"Parse Error: {e}")
+        return None
+
+
+"""Per-handler counters, reported periodically and on shutdown
+"""
+class ConsumerMetrics(object):
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.received = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.handler_secs = 0.0
+
+    def record(self, succeeded, secs):
+        with self.lock:
+            if succeeded:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            self.handler_secs += secs
+
+    def report(self):
+        with self.lock:
+            handled = self.succeeded + self.failed
+            average = self.handler_secs / handled if handled else 0
+            print(f"[{self.name}] received: {self.received}, " \
+                  f"succeeded: {self.succeeded}, failed: {self.failed}, " \
+                  f"average handler time: {average:.2f} seconds")
+
+
+"""Consumes an SQS queue with a pool of worker threads
+"""
+class SqsConsumer(object):
+    def __init__(self, queue_name, handler, region_name=None, workers=4,
+                 max_messages=10, wait_time=20, visibility_timeout=None,
+                 heartbeat_interval=None, metrics_interval=60, name=None):
+        self.handler = handler
+        self.region_name = region_name
+        self.workers = workers
+        self.max_messages = min(max_messages, 10)
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.metrics_interval = metrics_interval
+        self.metrics = ConsumerMetrics(name or queue_name)
+
+        self.sqs = aws_clients.get_client("sqs", region_name)
+        self.queue_url = self.sqs.get_queue_url(QueueName=queue_name)["QueueUrl"]
+
+        # Receipt handles of messages being handled, and of messages
+        # waiting to be deleted
+        self.lock = threading.Condition()
+        self.in_flight = set()
+        self.acks = []
+        self.stopping = threading.Event()
+        self.drained = threading.Event()
+
+    def receive(self, max_number):
+        # Claimed messages are hidden for visibility_timeout right away,
+        # not the queue default, until the first heartbeat
+        options = {}
+        if self.visibility_timeout:
+            options["VisibilityTimeout"] = self.visibility_timeout
+        try:
+            response = self.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=max_number,
+                WaitTimeSeconds=self.wait_time,
+                **options
+            )
+        except ClientError as e:
+            print(e)
+            return []
+        messages = response.get("Messages", [])
+        with self.metrics.lock:
+            self.metrics.received += len(messages)
+        return messages
+
+    def handle(self, message):
+        start = time.time()
+        succeeded = False
+        try:
+            data = parse_message(message["Body"])
+            if data is not None:
+                succeeded = bool(self.handler(data))
+        except Exception as e:
+            print(f"[{self.metrics.name}] handler failed: {e!r}")
+        self.metrics.record(succeeded, time.time() - start)
+
+        with self.lock:
+            self.in_flight.discard(message["ReceiptHandle"])
+            if succeeded:
+                self.acks.append(message["ReceiptHandle"])
+            self.lock.notify_all()
+
+    def batch_entries(self, handles, **fields):
+        for i in range(0, len(handles), 10):
+            yield [dict(Id=str(n), ReceiptHandle=handle, **fields)
+                   for n, handle in enumerate(handles[i:i + 10])]
+
+    def flush_acks(self):
+        """
+        Delete handled messages, 10 per request
+        """
+        with self.lock:
+            handles, self.acks = self.acks, []
+        for entries in self.batch_entries(handles):
+            try:
+                response = self.sqs.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=entries
+                )
+            except ClientError as e:
+                print(e)
+                continue
+            for failure in response.get("Failed", []):
+                print(f"Unable to delete message: {failure}")
+
+    def extend_visibility(self):
+        """
+        Keep messages that are still being handled hidden from other
+        consumers, 10 per request
+        """
+        with self.lock:
+            handles = list(self.in_flight)
+        for entries in self.batch_entries(
+                handles, VisibilityTimeout=self.visibility_timeout):
+            try:
+                response = self.sqs.change_message_visibility_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=entries
+                )
+            except ClientError as e:
+                print(e)
+                continue
+            for failure in response.get("Failed", []):
+                print(f"Unable to extend message visibility: {failure}")
+
+    def housekeeping(self):
+        """
+        Background loop: delete handled messages promptly, send visibility
+        heartbeats and report metrics
+        """
+        last_heartbeat = last_report = time.time()
+        while not self.drained.wait(1):
+            self.flush_acks()
+            now = time.time()
+            if self.heartbeat_interval and \
+                    now - last_heartbeat >= self.heartbeat_interval:
+                self.extend_visibility()
+                last_heartbeat = now
+            if now - last_report >= self.metrics_interval:
+                self.metrics.report()
+                last_report = now
+
+    def stop(self, *args):
+        print(f"[{self.metrics.name}] stopping after in-flight messages")
+        self.stopping.set()
+        with self.lock:
+            self.lock.notify_all()
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        housekeeper = threading.Thread(target=self.housekeeping, daemon=True)
+        housekeeper.start()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.stopping.is_set():
+                # Only take as many messages as there are idle workers
+                with self.lock:
+                    while len(self.in_flight) >= self.workers and \
+                            not self.stopping.is_set():
+                        self.lock.wait()
+                    free_workers = self.workers - len(self.in_flight)
+                if self.stopping.is_set():
+                    break
+
+                for message in self.receive(min(self.max_messages,
+                                                free_workers)):
+                    with self.lock:
+                        self.in_flight.add(message["ReceiptHandle"])
+                    executor.submit(self.handle, message)
+
+            # Leaving the executor waits for in-flight messages
+        self.drained.set()
+        housekeeper.join()
+        self.flush_acks()
+        self.metrics.report()
+
+
+def create_consumer(runtime, *args, **kwargs):
+    """
+    Build a consumer for the configured runtime: "threads" (the default)
+    or "asyncio"
+    """
+    if runtime == "asyncio":
+        from aio_consumer import AsyncSqsConsumer
+        return AsyncSqsConsumer(*args, **kwargs)
+    return SqsConsumer(*args, **kwargs)
+
+### EOF
@@ -9,13 +9,19 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import sys
-import json
-import boto3
-from botocore.exceptions import ClientError
+import time
+import threading
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import BotoCoreError, ClientError
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import aws_clients
+import sqs_consumer
+import glacier_transfer
+import restore_jobs
+import result_index
 
 # Get configuration
 from configparser import ConfigParser
@@ -27,124 +33,112 @@ config.read('thaw_config.ini')
 """
 ## ------------------------- HELPER FUNCTIONS -------------------------------##
 """
-def receive_message(url):
+def clear_restore_request(job_id, results_file_archive_id):
+    """
+    Drop the restore flags of a job whose retrieval failed, so the UI stops
+    showing it as being restored and the restore can be requested again
+    (by viewing the file, or by the next user-level restore)
+    """
+    table = aws_clients.get_table(dynamo_table_name, region_name)
     try:
-        response = sqs_client.receive_message(
-            QueueUrl=url,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=int(config["aws"]["WaitTimeBetweenMessage"])
+        table.update_item(
+            Key={"job_id": job_id},
+            UpdateExpression="REMOVE restore_message, interactive_restore_time",
+            ConditionExpression=Attr("results_file_archive_id").eq(
+                results_file_archive_id)
         )
     except ClientError as e:
-        print(e)
-        return None
-    messages = response.get("Messages", [])
-    print(f"Number of messages received: {len(messages)}")
-    if len(messages) > 0:
-        return messages[0]
-    return None
-
-def parse_response(response):
-    print(response)
+        # Already restored by another retrieval
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+
+def handle_thaw_message(json_data):
+    """
+    Move a retrieved archive back to S3 once Glacier reports the retrieval
+    job complete; returns True once the message can be deleted
+    """
+    restore_job_id = json_data["JobId"]
     try:
-        json_response = json.loads(response)
-        json_body = json.loads(json_response["Message"])
-        return json_body
-    except Exception as e:
-        print("Parse Error")
-        print(e)
-        return None
-
-def delete_msg(url, handle):
-    try:
-        response = sqs_client.delete_message(
-            QueueUrl=url,
-            ReceiptHandle=handle,
-        )
-        messageID = response["ResponseMetadata"]["RequestId"]
-        print("message deleted")
+        restore_job = restore_jobs.get_job(restore_job_id, region_name)
     except ClientError as e:
         print(e)
-
-"""
-## ---------------------------- MAIN LOOP ------------------------------------##
-"""
-# Fetch item from config file
-region_name = config["aws"]['AwsRegionName']
-sqs_queue_name = config["aws"]['AwsSqsThaw']
-dynamo_table_name = config["aws"]["AwsDynamodbAnnotationsTable"]
-
-try:
-    sqs_client = boto3.client("sqs", region_name = region_name)
-    queue_url = sqs_client.get_queue_url(QueueName=sqs_queue_name)["QueueUrl"]
-except ClientError as e:
-    print("Error Here")
-    print(e)
-    raise e
-
-# Main Loop
-# Add utility code here
-
-while True:
-    # Long poll for message on provided SQS queue, if no response, continue
-    response = receive_message(queue_url)
-    if response == None:
-        continue
-    
-    message_handle = response["ReceiptHandle"]
-    message_body = response["Body"]
-
-    # If json_data is not successfully parsed, continue
-    json_data = parse_response(message_body)
-    if json_data == None:
-        continue
-    
-    # Remove file from S3 and add to Glacier
-    user_id = json_data["user_id"]
-    restore_job_id = json_data["restore_job_id"]
-    restored_file_location = json_data["location"]
-    results_file_archive_id = json_data["results_file_archive_id"]
-    restore_request_id = json_data["restore_request_id"]
-    job_id = json_data["job_id"]
-
-    # Initiate Job to restore archived data
-    region_name = config["aws"]["AwsRegionName"]
-    client = boto3.client('glacier', region_name = region_name)
-    glacier_vault = config["aws"]["AwsGlacierVault"]
-    
+        return False
+    # Jobs no longer tracked have already been thawed
+    if restore_job is None:
+        print(f"Restore job {restore_job_id} is not outstanding")
+        return True
+    if json_data.get("StatusCode") != "Succeeded":
+        print(f"Restore job {restore_job_id} failed: {json_data.get('StatusMessage')}")
+        try:
+            restore_jobs.fail_job(restore_job_id,
+                                  json_data.get("StatusMessage") or "Failed",
+                                  region_name)
+            clear_restore_request(restore_job["job_id"],
+                                  restore_job["results_file_archive_id"])
+        except ClientError as e:
+            print(e)
+            return False
+        return True
+
+    results_file_archive_id = restore_job["results_file_archive_id"]
+    job_id = restore_job["job_id"]
+
+    # The results file goes back under its original key
     try:
-        results_file = client.get_job_output(vaultName=glacier_vault, jobId=restore_job_id)['body']
-        print(result_file)
-    except ClientError as e:
+        table = aws_clients.get_table(dynamo_table_name, region_name)
+        item = table.get_item(Key={"job_id": job_id})["Item"]
+    except (ClientError, KeyError) as e:
         print(e)
-        continue
+        return False
+    s3_key_result_file = item["s3_key_result_file"]
+
+    # An interactive restore may have raced a bulk one for the same file
+    if item.get("results_file_archive_id") != results_file_archive_id:
+        print(f"Results of job {job_id} were already restored")
+        try:
+            restore_jobs.finish_job(restore_job_id, region_name)
+        except ClientError as e:
+            print(e)
+            return False
+        return True
+
+    client = aws_clients.get_client('glacier', region_name)
+    glacier_vault = config["aws"]["AwsGlacierVault"]
 
+    # Stream the restored archive back to S3, part by part
     try:
-        s3 = boto3.client('s3', region_name = region_name)
-        response = s3.put_object(
-            Bucket=config["aws"]["AwsS3ResultBucket"],
-            Key= config["aws"]["S3Header"] + user_id + "/"+job_id+"~"+"better_work.annot.vcf",
-            Body=results_file.read()
-        )
-        print(response)
-    except ClientError as e:
+        s3 = aws_clients.get_client('s3', region_name)
+        glacier_transfer.restore_archive_to_s3(
+            client, glacier_vault, restore_job_id,
+            s3, config["aws"]["AwsS3ResultsBucket"], s3_key_result_file)
+        print(f"Restored {s3_key_result_file} from Glacier job {restore_job_id}")
+    except (BotoCoreError, ClientError, IOError) as e:
         print(e)
-        continue
+        return False
+
+    # Archiving dropped the block index of BGZF results; without it the
+    # file can still be downloaded, just not queried by region
+    if s3_key_result_file.endswith(".gz"):
+        try:
+            if result_index.rebuild_index(s3, config["aws"]["AwsS3ResultsBucket"],
+                                          s3_key_result_file):
+                print(f"Rebuilt the region index of {s3_key_result_file}")
+        except (BotoCoreError, ClientError, IOError) as e:
+            print(f"Unable to rebuild the region index of {s3_key_result_file}: {e}")
 
     try:
-        remove_response = glacier.delete_archive(vaultName=glacier_vault, archiveId=results_file_archive_id)
+        remove_response = client.delete_archive(vaultName=glacier_vault, archiveId=results_file_archive_id)
         print(remove_response)
     except ClientError as e:
         print(e)
-        continue
+        return False
 
-    dynamo_table_name = config["aws"]["AwsDynamodbAnnotationsTable"]
     try:
-        dynamo = boto3.resource('dynamodb')
-        table = dynamo.Table(dynamo_table_name)
-        response = table.update_item(
+        table.update_item(
             Key = {"job_id": job_id},
-            UpdateExpression="""DELETE restore_message,
-                                results_file_archive_id
+            UpdateExpression="""REMOVE restore_message,
+                                results_file_archive_id,
+                                interactive_restore_time
                                 """,
             ReturnValues="UPDATED_OLD"
         )
@@ -153,8 +147,54 @@ while True:
         pass
     print("Dynamo DB Removed Restore Message and archive ID")
 
-    # Delete the message using its handle
-    delete_msg(queue_url, message_handle)
-    print('File ' + str(this_job_id) + ' transfer complete!')
+    try:
+        restore_jobs.finish_job(restore_job_id, region_name)
+    except ClientError as e:
+        print(e)
+
+    print('File ' + str(job_id) + ' transfer complete!')
+    return True
+
+def poll_restore_jobs():
+    """
+    Background loop dispatching tracked jobs whose Glacier completion
+    notification never arrived
+    """
+    while True:
+        time.sleep(int(config["aws"]["RestoreJobsPollInterval"]))
+        try:
+            dispatched = restore_jobs.dispatch_ready_jobs(
+                config["aws"]["AwsGlacierVault"],
+                config["aws"]["AwsSnsThawTopic"],
+                int(config["aws"]["RestoreJobsSettleTime"]),
+                region_name)
+            if dispatched:
+                print(f"Dispatched {dispatched} restore jobs missed by notifications")
+        except (BotoCoreError, ClientError) as e:
+            print(f"Unable to poll restore jobs: {e}")
+
+"""
+## ---------------------------- MAIN LOOP ------------------------------------##
+"""
+# Fetch item from config file
+region_name = config["aws"]['AwsRegionName']
+sqs_queue_name = config["aws"]['AwsSqsThaw']
+dynamo_table_name = config["aws"]["AwsDynamodbAnnotationsTable"]
+
+# Main Loop
+threading.Thread(target=poll_restore_jobs, daemon=True).start()
+consumer = sqs_consumer.create_consumer(
+    config["aws"]["Runtime"],
+    sqs_queue_name,
+    handle_thaw_message,
+    region_name=region_name,
+    workers=int(config["aws"]["ConsumerWorkers"]),
+    max_messages=int(config["aws"]["MaxMessagesPerReceive"]),
+    wait_time=int(config["aws"]["WaitTimeBetweenMessage"]),
+    visibility_timeout=int(config["aws"]["VisibilityTimeout"]),
+    heartbeat_interval=int(config["aws"]["HeartbeatInterval"]),
+    name="thaw"
+)
+consumer.run()
 
 ### EOF
\ No newline at end of file
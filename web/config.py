@@ -9,13 +9,16 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
-import json
-import boto3
+import sys
 import base64
 from botocore.exceptions import ClientError
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# Secrets are read through the cache shared with the utilities
+sys.path.append(os.path.join(basedir, '..', 'util'))
+import secrets_cache
+
 class Config(object):
   GAS_LOG_LEVEL = os.environ['GAS_LOG_LEVEL'] \
     if ('GAS_LOG_LEVEL' in os.environ) else 'INFO'
@@ -37,13 +40,16 @@ class Config(object):
   AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] \
     if ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
-  # Get various credentials from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+  # Get various credentials from AWS Secrets Manager, in a single request
+  # where possible
+  secrets_cache.prefetch_secrets(
+    ['gas/web_server', 'rds/accounts_database', 'globus/auth_client'],
+    region_name=AWS_REGION_NAME)
 
   # Get Flask application secret
   try:
-    asm_response = asm.get_secret_value(SecretId='gas/web_server')
-    flask_secret = json.loads(asm_response['SecretString'])
+    flask_secret = secrets_cache.get_secret('gas/web_server',
+      region_name=AWS_REGION_NAME)
   except ClientError as e:
     print(f"Unable to retrieve Flask secret from ASM: {e}")
     raise e
@@ -51,8 +57,8 @@ class Config(object):
 
   # Get RDS secret and construct database URI
   try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
+    rds_secret = secrets_cache.get_secret('rds/accounts_database',
+      region_name=AWS_REGION_NAME)
   except ClientError as e:
     print(f"Unable to retrieve accounts database credentials from ASM: {e}")
     raise e
@@ -66,8 +72,8 @@ class Config(object):
 
   # Get the Globus Auth client ID and secret
   try:
-    asm_response = asm.get_secret_value(SecretId='globus/auth_client')
-    globus_auth = json.loads(asm_response['SecretString'])
+    globus_auth = secrets_cache.get_secret('globus/auth_client',
+      region_name=AWS_REGION_NAME)
   except ClientError as e:
     print(f"Unable to retrieve Globus Auth credentials from ASM: {e}")
     raise e
@@ -98,12 +104,28 @@ class Config(object):
   AWS_SNS_RESULT_RESTORE_TOPIC = \
     "arn:aws:sns:us-east-1:659248683008:hanzeh_results_restore"
 
+  # Shown instead of the download link while a result is being restored
+  RESULT_RESTORE_MESSAGE = \
+    "Your Annotation Result File is Currently being restored"
+
   # Change the table name to your own
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "hanzeh_annotations"
 
+  # Index on user_id with submit_time as its sort key, used to list a
+  # user's jobs newest first, and the number of jobs listed per page
+  AWS_DYNAMODB_USER_JOBS_INDEX = "user_id_index"
+  ANNOTATIONS_PAGE_SIZE = 25
+
   # Change the email address to your username
   MAIL_DEFAULT_SENDER = "hanzeh@mpcs-cc.com"
 
+  # Time a user profile read from the accounts database is reused by
+  # later requests (in seconds)
+  PROFILE_CACHE_TTL = 30
+
+  # Number of parsed result block indexes kept for region queries
+  REGION_INDEX_CACHE_SIZE = 64
+
   # Time before free user results are archived (in seconds)
   FREE_USER_DATA_RETENTION = 300
 
@@ -0,0 +1,72 @@
+# profile_cache.py
+#
+# Cache of user profiles for authenticated routes
+#
+# A profile is read from the accounts database at most once per request
+# and is then reused by other requests in the same worker process for up
+# to PROFILE_CACHE_TTL seconds. Inserting or updating a Profile (e.g. via
+# auth.update_profile when a user subscribes) invalidates its entry.
+##
+import time
+from collections import namedtuple
+from threading import Lock
+
+from flask import g, has_request_context, session
+from sqlalchemy import event
+
+from gas import app, db
+from models import Profile
+
+"""Read-only snapshot of a Profile row
+Cached entries outlive the database session that loaded them, so the
+column values are copied out of the ORM instance
+"""
+CachedProfile = namedtuple('CachedProfile',
+  ['identity_id', 'name', 'email', 'institution', 'role'])
+
+profile_cache = {'lock': Lock(), 'profiles': {}}
+
+"""Get a user's profile, from the cache if possible
+"""
+def get_cached_profile(identity_id=None):
+  key = str(identity_id)
+  request_profiles = g.setdefault('profiles', {})
+  if key in request_profiles:
+    return request_profiles[key]
+
+  # Entries cached before the user's own last profile change are stale,
+  # even when that change was handled by another worker process
+  changed_at = session.get('profile_changed_at', 0) \
+    if session.get('primary_identity') == key else 0
+  with profile_cache['lock']:
+    entry = profile_cache['profiles'].get(key)
+  if entry and entry[0] >= changed_at and \
+    time.time() - entry[0] < app.config['PROFILE_CACHE_TTL']:
+    profile = entry[1]
+  else:
+    row = db.session.query(Profile).filter_by(identity_id=identity_id).first()
+    profile = CachedProfile(row.identity_id, row.name, row.email,
+      row.institution, row.role) if row else None
+    with profile_cache['lock']:
+      profile_cache['profiles'][key] = (time.time(), profile)
+
+  request_profiles[key] = profile
+  return profile
+
+"""Drop a user's cached profile
+"""
+def invalidate_profile(identity_id=None):
+  key = str(identity_id)
+  with profile_cache['lock']:
+    profile_cache['profiles'].pop(key, None)
+  if has_request_context():
+    g.setdefault('profiles', {}).pop(key, None)
+    if session.get('primary_identity') == key:
+      session['profile_changed_at'] = time.time()
+
+@event.listens_for(Profile, 'after_insert')
+@event.listens_for(Profile, 'after_update')
+def profile_changed(mapper, connection, target):
+  invalidate_profile(identity_id=target.identity_id)
+
+### EOF
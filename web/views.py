@@ -8,22 +8,42 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import os
+import re
+import sys
 import uuid
 import time
 import json
+import base64
+import binascii
+from threading import Lock
+from collections import OrderedDict
 from datetime import datetime
+from decimal import Decimal
 
-import boto3
-from boto3.dynamodb.conditions import Key
-from botocore.client import Config
+from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError
 
 from flask import (abort, flash, redirect, render_template,
-  request, session, url_for)
+  request, session, url_for, Response, stream_with_context)
 
 from gas import app, db
 from decorators import authenticated, is_premium
-from auth import get_profile, update_profile
+from auth import update_profile
+from profile_cache import get_cached_profile
+
+# Shared AWS clients, reused across requests
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+  '..', 'util'))
+import aws_clients
+import result_index
+
+# Contig names allowed by the VCF specification
+CHROM_PATTERN = re.compile(r"[0-9A-Za-z!#$%&+./:;?@^_|~-][0-9A-Za-z!#$%&*+./:;=?@^_|~-]*")
+
+# Parsed block indexes of result files, most recently used last. Result
+# files never change under their key, so entries do not expire
+region_index_cache = {'lock': Lock(), 'indexes': OrderedDict()}
 
 
 """Start annotation request
@@ -37,9 +57,9 @@ but you can replace the code below with your own if you prefer.
 @authenticated
 def annotate():
   # Create a session client to the S3 service
-  s3 = boto3.client('s3',
+  s3 = aws_clients.get_client('s3',
     region_name=app.config['AWS_REGION_NAME'],
-    config=Config(signature_version='s3v4'))
+    signature_version='s3v4')
 
   bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
   user_id = session['primary_identity']
@@ -105,7 +125,6 @@ def create_annotation_job_request():
 
   # Extract the user id
   user_id = session.get('primary_identity')
-  profile = get_profile(identity_id=user_id)
 
   # Get DynamoDB table name from config
   dynamo_table_name = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
@@ -121,8 +140,7 @@ def create_annotation_job_request():
            "job_status": "PENDING"
           }
   try:
-    dynamo = boto3.resource('dynamodb', region_name=region_name)
-    table = dynamo.Table(dynamo_table_name)
+    table = aws_clients.get_table(dynamo_table_name, region_name)
     response = table.put_item(Item = data)
   except ClientError as e:
     app.logger.info(f"An Error was encountered when pushing to dyanmoDB: {e}")
@@ -133,7 +151,7 @@ def create_annotation_job_request():
 
   # Send message to request queue
   try:
-    sns = boto3.client("sns", region_name = region_name)
+    sns = aws_clients.get_client("sns", region_name)
     sns.publish(
       TopicArn=sns_topic_arn,
       MessageStructure="json",
@@ -160,23 +178,42 @@ def annotations_list():
   # Get User Id
   user_id = session['primary_identity']
 
+  # Fetch one page of the user's jobs, newest first, with only the columns
+  # that are listed. The page token is the opaque form of the key the
+  # previous page stopped at
+  query = {
+    "IndexName": app.config["AWS_DYNAMODB_USER_JOBS_INDEX"],
+    "KeyConditionExpression": Key('user_id').eq(user_id),
+    "ProjectionExpression": "job_id, submit_time, input_file_name, #s",
+    "ExpressionAttributeNames": {"#s": "job_status"},
+    "ScanIndexForward": False,
+    "Limit": app.config["ANNOTATIONS_PAGE_SIZE"]
+  }
+  page_token = request.args.get('page')
+  if page_token:
+    start_key = decode_page_token(page_token)
+    if not start_key or start_key.get("user_id") != user_id:
+      app.logger.info(f"Invalid annotations page token: {page_token}")
+      return abort(400)
+    query["ExclusiveStartKey"] = start_key
+
   annotations = []
   try:
-    dynamo = boto3.resource('dynamodb')
-    table = dynamo.Table(dynamo_table_name)
-    response = table.query(
-      IndexName = "user_id_index",
-      KeyConditionExpression = Key('user_id').eq(user_id)
-    )
+    table = aws_clients.get_table(dynamo_table_name, region_name)
+    response = table.query(**query)
     annotations = response['Items']
   except ClientError as e:
     app.logger.info(f"An Error was encountered when querying dynamoDB: {e}")
     return abort(500)
 
+  annotations.sort(key=lambda annotation: annotation["submit_time"],
+    reverse=True)
   for annotation in annotations:
     annotation["submit_time"] = convert_int_to_time(annotation["submit_time"])
 
-  return render_template('annotations.html', annotations=annotations)
+  next_page = encode_page_token(response.get('LastEvaluatedKey'))
+  return render_template('annotations.html', annotations=annotations,
+    next_page=next_page, first_page=not page_token)
 
 
 """Display details of a specific annotation job
@@ -191,11 +228,10 @@ def annotation_details(id):
 
   # Get User Id
   user_id = session['primary_identity']
-  profile = get_profile(identity_id=session.get('primary_identity'))
+  profile = get_cached_profile(identity_id=session.get('primary_identity'))
   annotation = {}
   try:
-    dynamo = boto3.resource('dynamodb')
-    table = dynamo.Table(dynamo_table_name)
+    table = aws_clients.get_table(dynamo_table_name, region_name)
     response = table.get_item(Key = {'job_id': id })
     annotation = response["Item"]
   except ClientError as e:
@@ -214,7 +250,7 @@ def annotation_details(id):
     input_file_name = annotation["input_file_name"]
     input_file_path = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + \
     annotation["job_id"] + f'~{input_file_name}'
-    s3 = boto3.client("s3")
+    s3 = aws_clients.get_client("s3", region_name, signature_version='s3v4')
     signed_download_input_file = s3.generate_presigned_url(
       'get_object',
       Params={
@@ -237,14 +273,24 @@ def annotation_details(id):
     app.logger.info(time_remaining)
     if profile.role == "premium_user":
       time_remaining = 300
-    if time_remaining > 0:
+      # Archived files are restored first for the user looking at them
+      if "results_file_archive_id" in annotation:
+        annotation["restore_message"] = request_interactive_restore(annotation)
+    if time_remaining <= 0:
+      free_access_expired = True
+    elif "restore_message" not in annotation:
       try:
-        s3 = boto3.client("s3")
+        s3 = aws_clients.get_client("s3", region_name,
+          signature_version='s3v4')
         presigned_download = s3.generate_presigned_url(
           'get_object',
           Params={
             'Bucket': app.config["AWS_S3_RESULTS_BUCKET"],
-            'Key': annotation_file_name
+            'Key': annotation_file_name,
+            # Save results (.annot.vcf, or BGZF .annot.vcf.gz) under their
+            # original file name
+            'ResponseContentDisposition': 'attachment; filename="' +
+              annotation_file_name.split('~', 1)[-1] + '"'
           },
           ExpiresIn=time_remaining
         )
@@ -252,8 +298,8 @@ def annotation_details(id):
       except ClientError as e:
         app.logger.error(f"Unable to generate generate presigned download for result file: {e}")
         return abort(500)
-    else:
-      free_access_expired = True
+      annotation["region_index"] = has_region_index(s3,
+        app.config["AWS_S3_RESULTS_BUCKET"], annotation_file_name)
 
   return render_template('annotation_details.html', annotation=annotation, free_access_expired = free_access_expired)
 
@@ -268,8 +314,8 @@ def annotation_log(id):# Get variables from config
 
   annotation = {}
   try:
-    dynamo = boto3.resource('dynamodb')
-    table = dynamo.Table(app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"])
+    table = aws_clients.get_table(app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"],
+      region_name)
     response = table.get_item(Key = {'job_id': id })
     annotation = response["Item"]
   except ClientError as e:
@@ -277,7 +323,7 @@ def annotation_log(id):# Get variables from config
     return abort(500)
 
   # Get the input file S3 object and copy it to a local file
-  s3 = boto3.client("s3", region_name = region_name)
+  s3 = aws_clients.get_client("s3", region_name)
 
   # Try to download file from bucket
   file_data = ""
@@ -298,6 +344,104 @@ def annotation_log(id):# Get variables from config
 
   return render_template('view_log.html', job_id=id, log_file_contents = file_data)
 
+"""Stream the annotated records of a genomic region
+Uses the block index of a BGZF result file to read only the blocks that
+hold chrom:start-end, instead of downloading the whole file
+"""
+@app.route('/annotations/<id>/region', methods=['GET'])
+@authenticated
+def annotation_region(id):
+  region_name = app.config["AWS_REGION_NAME"]
+  s3_result_bucket = app.config["AWS_S3_RESULTS_BUCKET"]
+
+  chrom = request.args.get('chrom', '')
+  # The region form sends start and end empty when they are left out
+  try:
+    start = int(request.args.get('start') or 1)
+    end = int(request.args.get('end') or 2**31)
+  except ValueError:
+    return abort(400)
+  if not CHROM_PATTERN.fullmatch(chrom) or start > end:
+    return abort(400)
+
+  try:
+    table = aws_clients.get_table(app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"],
+      region_name)
+    annotation = table.get_item(Key = {'job_id': id }).get("Item")
+  except ClientError as e:
+    app.logger.info(f"An Error was encountered when querying dynamoDB: {e}")
+    return abort(500)
+  if not annotation or "s3_key_result_file" not in annotation:
+    return abort(404)
+  if annotation["user_id"] != session['primary_identity']:
+    return abort(403)
+
+  # Same access rules as the full download
+  profile = get_cached_profile(identity_id=session.get('primary_identity'))
+  if (not profile or profile.role != "premium_user") and \
+    int(time.time()) - annotation["complete_time"] >= \
+    app.config["FREE_USER_DATA_RETENTION"]:
+    return abort(403)
+  if "results_file_archive_id" in annotation:
+    return abort(404)
+
+  result_key = annotation["s3_key_result_file"]
+  s3 = aws_clients.get_client("s3", region_name)
+  index = get_region_index(s3, s3_result_bucket, result_key)
+  if index is None:
+    return abort(404)
+
+  records = result_index.read_region(s3, s3_result_bucket, result_key,
+    index, chrom, start, end)
+  file_name = f"{id}.{chrom}_{start}_{end}.annot.vcf"
+  return Response(stream_with_context(records),
+    mimetype='text/tab-separated-values',
+    headers={'Content-Disposition': f'attachment; filename="{file_name}"'})
+
+def has_region_index(s3, s3_result_bucket, result_key):
+  """
+  Whether a result file can be queried by region, i.e. has a block index
+  (BGZF results do, unless they are still being restored)
+  """
+  with region_index_cache['lock']:
+    if result_key in region_index_cache['indexes']:
+      return True
+  try:
+    s3.head_object(Bucket=s3_result_bucket,
+      Key=result_key + result_index.INDEX_SUFFIX)
+  except ClientError:
+    return False
+  return True
+
+def get_region_index(s3, s3_result_bucket, result_key):
+  """
+  The parsed block index of a result file, from the cache if possible;
+  None if the file has no usable index (only BGZF results are indexed)
+  """
+  with region_index_cache['lock']:
+    index = region_index_cache['indexes'].get(result_key)
+    if index is not None:
+      region_index_cache['indexes'].move_to_end(result_key)
+      return index
+
+  try:
+    index = json.loads(s3.get_object(Bucket=s3_result_bucket,
+      Key=result_key + result_index.INDEX_SUFFIX)["Body"].read())
+  except (ClientError, ValueError) as e:
+    app.logger.info(f"No region index for {result_key}: {e}")
+    return None
+  if not isinstance(index, dict) or \
+    not isinstance(index.get("blocks"), list):
+    app.logger.info(f"Invalid region index for {result_key}")
+    return None
+
+  with region_index_cache['lock']:
+    region_index_cache['indexes'][result_key] = index
+    while len(region_index_cache['indexes']) > \
+      app.config['REGION_INDEX_CACHE_SIZE']:
+      region_index_cache['indexes'].popitem(last=False)
+  return index
+
 """Subscription management handler
 """
 @app.route('/subscribe', methods=['GET', 'POST'])
@@ -320,62 +464,27 @@ def subscribe():
     # Update role in the session
     session['role'] = "premium_user"
     user_id = session['primary_identity']
-    dynamo_table_name = app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"]
-
-    # Request restoration of the user's data from Glacier
-    # Add code here to initiate restoration of archived user data
-    # Make sure you handle files not yet archived!
-
-    # Get all annotations that has been archived for this user
-    annotations = []
-    dynamo = boto3.resource('dynamodb')
-    table = dynamo.Table(dynamo_table_name)
 
+    # Request restoration of the user's data from Glacier with a single
+    # user-level message; the restore utility looks up the user's archived
+    # results and fans the request out, so this returns immediately. The
+    # same message tells the archive utility to drop the user's cached role
+    region_name = app.config["AWS_REGION_NAME"]
+    sns_restore_topic = app.config["AWS_SNS_RESULT_RESTORE_TOPIC"]
+    data = {
+      "restore_type": "user",
+      "user_id": user_id
+    }
     try:
-      response = table.query(
-        IndexName = "user_id_index",
-        KeyConditionExpression = Key('user_id').eq(user_id),
-        FilterExpression = "attribute_exists (results_file_archive_id)"
+      sns = aws_clients.get_client("sns", region_name)
+      sns.publish(
+        TopicArn=sns_restore_topic,
+        MessageStructure="json",
+        Message=json.dumps({'default': json.dumps(data)})
       )
-      annotations = response['Items']
-      app.logger.info(annotations)
     except ClientError as e:
-      app.logger.info(f"An Error was encountered when querying dynamoDB: {e}")
+      app.logger.info(f"An Error was encountered when publishing to result restore SNS: {e}")
       return abort(500)
-    
-    region_name = app.config["AWS_REGION_NAME"]
-    sns_restore_topic = app.config["AWS_SNS_RESULT_RESTORE_TOPIC"]
-
-    # Send message to Result Restore queue
-    for annotation in annotations:
-      try:
-        job_id = annotation["job_id"]
-        data = {
-          "results_file_archive_id": annotation["results_file_archive_id"],
-          "user_id": annotation["user_id"],
-          "job_id": job_id
-        }
-        sns = boto3.client("sns", region_name = region_name)
-        sns.publish(
-          TopicArn=sns_restore_topic,
-          MessageStructure="json",
-          Message=json.dumps({'default': json.dumps(data)})
-        )
-      except ClientError as e:
-        app.logger.info(f"An Error was encountered when publishing to result restore SNS: {e}")
-        return abort(500)
-      
-      try:
-        response = table.update_item(
-          Key = {"job_id": job_id},
-          UpdateExpression="""set restore_message = :m""",
-          ExpressionAttributeValues= {":m": "Your Annotation Result File is Currently being restored"},
-          ReturnValues="UPDATED_OLD"
-        )
-        app.logger.info(response)
-      except ClientError as e:
-        app.logger.info(f"An Error was encountered when Updating restore message: {e}")
-        return abort(500)
 
     # Display confirmation page
     return render_template('subscribe_confirm.html') 
@@ -402,6 +511,79 @@ def convert_int_to_time(decimal_time):
   """
   return time.strftime("%d %b %Y %H:%M:%S", time.localtime(decimal_time))
 
+def encode_page_token(last_evaluated_key):
+  """
+  Turn a DynamoDB LastEvaluatedKey into an opaque, URL-safe page token
+  """
+  if not last_evaluated_key:
+    return None
+  key = {name: int(value) if isinstance(value, Decimal) else value
+    for name, value in last_evaluated_key.items()}
+  return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_page_token(page_token):
+  """
+  Turn a page token back into an ExclusiveStartKey; None if it is invalid
+  """
+  try:
+    key = json.loads(base64.urlsafe_b64decode(page_token.encode()))
+  except (binascii.Error, UnicodeDecodeError, ValueError):
+    return None
+  if not isinstance(key, dict) or \
+    not set(key) <= {"job_id", "user_id", "submit_time"}:
+    return None
+  return key
+
+def request_interactive_restore(annotation):
+  """
+  Ask for an archived result file that a premium user is viewing to be
+  restored ahead of any bulk restore, at most once per file. Returns the
+  message to show in place of the download link
+  """
+  region_name = app.config["AWS_REGION_NAME"]
+  restore_message = app.config["RESULT_RESTORE_MESSAGE"]
+  request_time = int(time.time())
+  try:
+    table = aws_clients.get_table(app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"],
+      region_name)
+    table.update_item(
+      Key={"job_id": annotation["job_id"]},
+      UpdateExpression="set interactive_restore_time = :t, restore_message = :m",
+      ConditionExpression=Attr("interactive_restore_time").not_exists() &
+        Attr("results_file_archive_id").exists(),
+      ExpressionAttributeValues={":t": request_time, ":m": restore_message}
+    )
+  except ClientError as e:
+    if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+      app.logger.error(f"Unable to flag interactive restore: {e}")
+    return restore_message
+
+  data = {
+    "results_file_archive_id": annotation["results_file_archive_id"],
+    "user_id": annotation["user_id"],
+    "job_id": annotation["job_id"],
+    "priority": "interactive"
+  }
+  try:
+    sns = aws_clients.get_client("sns", region_name)
+    sns.publish(
+      TopicArn=app.config["AWS_SNS_RESULT_RESTORE_TOPIC"],
+      MessageStructure="json",
+      Message=json.dumps({'default': json.dumps(data)})
+    )
+  except ClientError as e:
+    app.logger.error(f"Unable to request interactive restore: {e}")
+    # Drop the flag so that the next view of the file asks again
+    try:
+      table.update_item(
+        Key={"job_id": annotation["job_id"]},
+        UpdateExpression="remove interactive_restore_time",
+        ConditionExpression=Attr("interactive_restore_time").eq(request_time),
+      )
+    except ClientError as e:
+      app.logger.error(f"Unable to clear interactive restore flag: {e}")
+  return restore_message
+
 """DO NOT CHANGE CODE BELOW THIS LINE
 *******************************************************************************
 """